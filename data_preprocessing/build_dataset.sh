@@ -76,21 +76,18 @@ python "data_preprocessing/sample_patient_profile.py" \
     --preprocess_dir "$SAVE_DIR" \
     --save_dir "$SAVE_DIR" 
 
-python "data_preprocessing/key_extraction.py" \
-    --data_dir "$SAVE_DIR" \
-    --save_dir "$SAVE_DIR" \
-    --exp_name "profile_extraction" \
-    --prompt_dir "prompts/data_preprocessing/key_extraction" \
-
-python "data_preprocessing/data_filtering.py" \
-    --data_dir "$SAVE_DIR" \
-    --key_dir "$SAVE_DIR/profile_extraction" \
-    --prompt_dir "prompts/data_preprocessing/data_filtering" 
-    
-python "data_preprocessing/key_modification.py" \
+# Key extraction, filtering and key modification run in one process: the dataset
+# is read and the model client set up once, and modification requests start as
+# soon as each filtering answer arrives.
+# To use a local vLLM model, start it once as an OpenAI-compatible server, e.g.
+#   python -m vllm.entrypoints.openai.api_server --model <model> --port 8000
+# and add: --model_api_type vllm_server --vllm_base_url http://localhost:8000/v1
+python "data_preprocessing/pipeline.py" \
     --data_dir "$SAVE_DIR" \
     --key_dir "$SAVE_DIR/profile_extraction" \
-    --prompt_dir "prompts/data_preprocessing/key_modification" 
+    --extraction_prompt_dir "prompts/data_preprocessing/key_extraction" \
+    --filtering_prompt_dir "prompts/data_preprocessing/data_filtering" \
+    --modification_prompt_dir "prompts/data_preprocessing/key_modification" 
 
 cp "$SAVE_DIR/profile_extraction/gemini-2.5-flash_mod_results.json" "$SAVE_DIR/sample_dict.json"
 
@@ -1,16 +1,15 @@
 import os
-import re
 import sys
-import ast
 import json
 import time
 import logging
 import pandas as pd
+from functools import partial
 
 os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import file_to_string, find_missing_keys, save_to_json
-from models import get_response_method, vllm_model_setup, get_answer
+from utils import file_to_string, save_to_json
+from llm_utils import ResponseCache, make_client, add_llm_args, run_rows, setup_logging, check_template_fields, build_messages, call_llm, read_sample_df, load_or_build_frame
 
 
 USED_COLUMNS = [
@@ -43,6 +42,35 @@ USED_COLUMNS = [
 ]
 
 
+def build_merged(df, raw_results):
+    """
+    Flatten the extracted keys and merge them with the sampled dataset.
+    """
+    # Flatten the nested sections while building the rows, so the frame is allocated once
+    rows = []
+    for hadm_id, result in raw_results.items():
+        row = {"hadm_id": hadm_id}
+        row.update((k, v) for k, v in result.items() if k not in ("demographics", "social_history", "present_illness"))
+        row.update(result.get("demographics") or {})
+        row.update(result.get("social_history") or {})
+        row.update((f"present_illness_{k}", v) for k, v in (result.get("present_illness") or {}).items())
+        rows.append(row)
+    results_df = pd.DataFrame(rows).set_index("hadm_id")
+    print(results_df.columns)
+
+    # Equi-join on the hadm_id index; suffixes mirror DataFrame.merge for overlapping columns
+    merged = df.set_index("hadm_id").join(results_df, how="inner", lsuffix="_x", rsuffix="_y").reset_index()
+    merged = merged.rename(columns={"mapped_icd_title": "diagnosis"})
+    print(merged.columns)
+    return merged[USED_COLUMNS]
+
+
+def process_row(row, client, model, system_prompt, user_prompt_template, args, cache=None):
+    hadm_id = str(int(row["hadm_id"]))
+    messages = build_messages(row, system_prompt, user_prompt_template)
+    return hadm_id, call_llm(hadm_id, messages, client, model, args, cache)
+
+
 def main(args):
     model = args.model
     logging.info(f"Using LLM: {model}")
@@ -51,68 +79,37 @@ def main(args):
     system_prompt = file_to_string(os.path.join(args.prompt_dir, "initial_system.txt"))
     user_prompt_template = file_to_string(os.path.join(args.prompt_dir, "initial_user.txt"))
 
-    # Load dataset
-    df = pd.read_csv(os.path.join(args.data_dir, "sample_df.csv"), dtype={"hadm_id": str})
-    print(df.shape)
-
     print(f"{args.model_api_type} api call")
-    client = get_response_method(args.model_api_type)
-    model = vllm_model_setup(args.model) if "vllm" in args.model else args.model
+    client, model = make_client(args)
+    cache = None if args.no_cache else ResponseCache(args.cache_dir)
 
-    # Load JSON key data and merge with the dataset
+    # Load dataset and JSON key data and merge them; the merged frame is reused while neither input changes
     results_path = os.path.join(args.key_dir, f"{args.model}_results.json")
-    with open(results_path, "r") as f:
-        raw_results = json.load(f)
-
-    results_df = pd.DataFrame.from_dict(raw_results, orient="index").reset_index().rename(columns={"index": "hadm_id"})
-    demog_df = pd.json_normalize(results_df["demographics"])
-    social_df = pd.json_normalize(results_df["social_history"])
-    present_illness_df = pd.json_normalize(results_df["present_illness"]).add_prefix("present_illness_")
-    results_df = pd.concat([results_df.drop(["demographics", "social_history", "present_illness"], axis=1), demog_df, social_df, present_illness_df], axis=1)
-    print(results_df.columns)
 
-    merged = df.merge(results_df, on="hadm_id", how="inner")
-    merged = merged.rename(columns={"mapped_icd_title": "diagnosis"})
-    print(merged.columns)
-    merged = merged[USED_COLUMNS]
+    def load_and_merge():
+        df = read_sample_df(args.data_dir, USED_COLUMNS + ["mapped_icd_title"])
+        print(df.shape)
+        with open(results_path, "r") as f:
+            raw_results = json.load(f)
+        return build_merged(df, raw_results)
+
+    merged_path = os.path.join(args.key_dir, f"{args.model}_filtering_merged.pkl")
+    merged = load_or_build_frame(merged_path, [os.path.join(args.data_dir, "sample_df.csv"), results_path], load_and_merge, params=USED_COLUMNS)
 
     if args.debug:
         merged = merged[:1]
 
-    # Extract dataset using chatgpt model
-    final_results = {}
-    for i, row in merged.iterrows():
-        hadm_id = str(int(row["hadm_id"]))
-        user_prompt = user_prompt_template.format(**row)
-        missing_keys = find_missing_keys(user_prompt_template, row)
-        assert missing_keys == [], f"Missing keys in row {i}: {missing_keys}"
-        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
-
-        response_cur = None
-        logging.info(f"Extract information with {args.model}")
-        logging.info(f"messages:")
-        for message in messages:
-            _role = message["role"]
-            _content = message["content"]
-            logging.info(f"\t{_role}: {_content}")
-
-        response_cur = client(model=model, message=messages, temperature=args.temperature, seed=args.random_seed, thinking_budget=args.thinking_budget)
-        output = get_answer(response_cur)
-
-        # Logging Token Information
-        logging.info(f"GPT Output:\n " + output + "\n")
-        output = re.search(r"\{.*\}", output, re.DOTALL).group()
-
-        try:
-            answer = ast.literal_eval(output)
-            answer = json.dumps(answer)
-            answer = json.loads(answer)
-        except:
-            answer = output
-
-        final_results[hadm_id] = answer
+    check_template_fields(user_prompt_template, merged.columns)
+
+    # Extract dataset using chatgpt model, issuing requests concurrently since each call is network-bound
+    process = partial(process_row, client=client, model=model, system_prompt=system_prompt, user_prompt_template=user_prompt_template, args=args, cache=cache)
+    checkpoint_path = os.path.join(args.key_dir, f"{args.model}_filtering_results.jsonl")
+    records = merged.to_dict(orient="records")
+    done = run_rows(process, records, checkpoint_path, args.concurrency)
 
+    final_results = {row["hadm_id"]: done[row["hadm_id"]] for row in records}
     save_to_json(final_results, os.path.join(args.key_dir, f"{args.model}_filtering_results.json"))
+    os.remove(checkpoint_path)
 
 
 if __name__ == "__main__":
@@ -130,10 +127,11 @@ if __name__ == "__main__":
             "gemini-2.5-flash"
         ],
     )
-    parser.add_argument("--model_api_type", type=str, default="genai", choices=["gpt_azure", "genai"])
+    parser.add_argument("--model_api_type", type=str, default="genai", choices=["gpt_azure", "genai", "vllm_server"])
     parser.add_argument("--temperature", type=float, default=0.0, help="model temperature")
     parser.add_argument("--random_seed", type=int, default=42)
     parser.add_argument("--thinking_budget", type=int, default=1024)
+    add_llm_args(parser)
 
     parser.add_argument("--data_dir", type=str, default="./data", help="save dir")
     parser.add_argument("--key_dir", type=str, default="./results/key_extraction", help="key_dir")
@@ -143,6 +141,6 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     now = datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
-    logging.basicConfig(filename=os.path.join(args.key_dir, "filtering_log.log"), level=logging.INFO)
+    setup_logging(os.path.join(args.key_dir, "filtering_log.log"), logging.DEBUG if args.verbose else logging.INFO)
 
     main(args)
@@ -1,15 +1,62 @@
 import os
-import re
 import sys
-import ast
-import json
 import logging
-import pandas as pd
+from functools import partial
 
 os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import file_to_string, find_missing_keys, save_to_json
-from models import get_response_method, vllm_model_setup, get_answer
+from utils import file_to_string, save_to_json
+from llm_utils import ResponseCache, make_client, add_llm_args, run_rows, setup_logging, check_template_fields, build_messages, call_llm, parse_answer, run_openai_batch, ResultCheckpoint, read_sample_df, template_fields
+
+
+def process_row(row, client, model, system_prompt, user_prompt_template, args, cache=None):
+    hadm_id = row["hadm_id"]
+    messages = build_messages(row, system_prompt, user_prompt_template)
+    return hadm_id, call_llm(hadm_id, messages, client, model, args, cache)
+
+
+def extraction_stage(args, client, model, df, system_prompt, user_prompt_template, concurrency, checkpoint_path, cache=None):
+    """
+    Extract the keys of every row in df and return them as {hadm_id: answer}, sorted by hadm_id.
+    """
+    check_template_fields(user_prompt_template, df.columns)
+    process = partial(process_row, client=client, model=model, system_prompt=system_prompt, user_prompt_template=user_prompt_template, args=args, cache=cache)
+    return dict(sorted(run_rows(process, df.to_dict(orient="records"), checkpoint_path, concurrency).items()))
+
+
+def batch_extraction_stage(args, df, system_prompt, user_prompt_template, checkpoint_path, cache=None):
+    """
+    Same as extraction_stage, but every request that is not cached is sent in one OpenAI Batch API job
+    instead of through the synchronous client. Rows whose batch request failed are left out of the
+    result and the checkpoint, so a rerun only resubmits those.
+    """
+    check_template_fields(user_prompt_template, df.columns)
+    with ResultCheckpoint(checkpoint_path) as checkpoint:
+        pending = {}
+        for row in df.to_dict(orient="records"):
+            hadm_id = row["hadm_id"]
+            if hadm_id in checkpoint.done:
+                continue
+            messages = build_messages(row, system_prompt, user_prompt_template)
+            cache_key = ResponseCache.make_key(args.model, messages, args.temperature, args.random_seed, args.thinking_budget)
+            output = cache.get(cache_key) if cache is not None else None
+            if output is None:
+                pending[hadm_id] = (messages, cache_key)
+            else:
+                checkpoint.add(hadm_id, parse_answer(output))
+        print(f"{len(checkpoint.done)} rows restored from checkpoint or cache, {len(pending)} submitted as a batch")
+
+        if pending:
+            outputs = run_openai_batch({hadm_id: messages for hadm_id, (messages, _) in pending.items()}, args.model, args.temperature, args.random_seed)
+            for hadm_id, output in outputs.items():
+                logging.info(f"GPT Output ({hadm_id}):\n " + output + "\n")
+                if cache is not None:
+                    cache.set(pending[hadm_id][1], output)
+                checkpoint.add(hadm_id, parse_answer(output))
+            if len(outputs) < len(pending):
+                print(f"{len(pending) - len(outputs)} batch requests failed; rerun to resubmit them")
+
+    return dict(sorted(checkpoint.done.items()))
 
 
 def main(args):
@@ -21,52 +68,23 @@ def main(args):
     user_prompt_template = file_to_string(os.path.join(args.prompt_dir, "initial_user.txt"))
 
     # Loading dataset
-    df = pd.read_csv(os.path.join(args.data_dir, "sample_df.csv"), dtype={"hadm_id": str})
+    df = read_sample_df(args.data_dir, ["hadm_id", *sorted(template_fields(user_prompt_template))])
     if args.debug:
         df = df[:5]
         
     print(df.shape)
     
     print(f"{args.model_api_type} api call")
-    client = get_response_method(args.model_api_type)
-    model = vllm_model_setup(args.model) if "vllm" in args.model else args.model
-
-    # Extract dataset using chatgpt model
-    total_result = {}
-    for i, row in df.iterrows():
-        hadm_id = row["hadm_id"]
-        user_prompt = user_prompt_template.format(**row)
-        missing_keys = find_missing_keys(user_prompt_template, row)
-        assert missing_keys == [], f"Missing keys in row {i}: {missing_keys}"
-        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
-
-        response_cur = None
-        logging.info(f"Extract information with {args.model}")
-        logging.info(f"messages:")
-        for message in messages:
-            _role = message["role"]
-            _content = message["content"]
-            logging.info(f"\t{_role}: {_content}")
-
-        response_cur = client(model=model, message=messages, temperature=args.temperature, seed=args.random_seed, thinking_budget=args.thinking_budget)
-        output = get_answer(response_cur)
-
-        # Logging Token Information
-        logging.info(f"GPT Output:\n " + output + "\n")
-        output = re.search(r"\{.*\}", output, re.DOTALL).group()
-
-        try:
-            answer = ast.literal_eval(output)
-            answer = json.dumps(answer)
-            answer = json.loads(answer)
-        except:
-            answer = output
-
-        total_result[hadm_id] = answer
-    
-    total_result = dict(sorted(total_result.items()))
+    client, model = make_client(args)
+    cache = None if args.no_cache else ResponseCache(args.cache_dir)
+
+    checkpoint_path = os.path.join(args.save_dir, f"{args.model}_results.jsonl")
+    if args.batch and not args.debug:
+        total_result = batch_extraction_stage(args, df, system_prompt, user_prompt_template, checkpoint_path, cache)
+    else:
+        total_result = extraction_stage(args, client, model, df, system_prompt, user_prompt_template, args.concurrency, checkpoint_path, cache)
     save_to_json(total_result, os.path.join(args.save_dir, f"{args.model}_results.json"))
-
+    os.remove(checkpoint_path)
 
 if __name__ == "__main__":
     import argparse
@@ -83,18 +101,22 @@ if __name__ == "__main__":
             "gemini-2.5-flash",
         ],
     )
-    parser.add_argument("--model_api_type", type=str, default="genai", choices=["gpt_azure", "genai"])
+    parser.add_argument("--model_api_type", type=str, default="genai", choices=["gpt_azure", "genai", "vllm_server"])
     parser.add_argument("--temperature", type=float, default=0.0, help="model temperature")
     parser.add_argument("--random_seed", type=int, default=42)
     parser.add_argument("--thinking_budget", type=int, default=1024)
+    add_llm_args(parser)
 
     parser.add_argument("--data_dir", type=str, default="./data", help="save dir")
     parser.add_argument("--save_dir", type=str, default="./results/key_extraction", help="save dir")
     parser.add_argument("--prompt_dir", type=str, default="./prompts/key_extraction", help="save directory")
-    parser.add_argument("--exp_name", type=str, default=None, help="experiment name")
+    parser.add_argument("--exp_name", type=str, default=None, help="experiment name; pass the name of an interrupted run to resume it")
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--batch", action="store_true", help="send the requests as one OpenAI Batch API job (gpt_azure only; ignored with --debug)")
 
     args = parser.parse_args()
+    if args.batch and args.model_api_type != "gpt_azure":
+        parser.error("--batch is only supported with --model_api_type gpt_azure")
 
     now = datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
     if args.exp_name is None:
@@ -106,6 +128,6 @@ if __name__ == "__main__":
     print(args.save_dir)
 
     os.makedirs(args.save_dir, exist_ok=True)
-    logging.basicConfig(filename=os.path.join(args.save_dir, "key_extraction.log"), level=logging.INFO)
+    setup_logging(os.path.join(args.save_dir, "key_extraction.log"), logging.DEBUG if args.verbose else logging.INFO)
 
     main(args)
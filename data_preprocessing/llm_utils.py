@@ -0,0 +1,407 @@
+"""
+Helpers shared by the LLM-based preprocessing scripts (key extraction, filtering and modification).
+"""
+
+import os
+import re
+import ast
+import json
+import time
+import string
+import atexit
+import logging
+import logging.handlers
+import queue
+import hashlib
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import jinja2
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from openai import OpenAI
+from models import get_answer, get_response_method, vllm_model_setup
+
+
+def setup_logging(log_path, level=logging.INFO):
+    """
+    Configure the root logger to write to log_path through a queue drained by a background thread,
+    so worker threads only enqueue records instead of blocking on file writes.
+    """
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, logging.FileHandler(log_path))
+    logging.basicConfig(level=level, handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def prompt_digest(messages):
+    """
+    Short hash of the message contents, to identify a prompt in the logs without writing it out.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for message in messages:
+        digest.update(message["content"].encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent cache of LLM outputs keyed on the request (model, messages, temperature, seed, thinking budget).
+    Each entry is stored in its own JSON file, so concurrent workers never write to the same file.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(model, messages, temperature, seed, thinking_budget):
+        """
+        Build a stable hash of everything that determines the model output.
+        """
+        payload = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature, "seed": seed, "thinking_budget": thinking_budget},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        Return the cached output for the key, or None on a miss.
+        """
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)["output"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def set(self, key, output):
+        """
+        Store the output for the key. The file is written to a temporary name first so readers never see a partial entry.
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"output": output}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+class ResultCheckpoint:
+    """
+    Append-only JSONL log of finished results, one {hadm_id: answer} object per line, so an interrupted run can resume.
+    Results already in the file are loaded into `done` on construction; lines are flushed every `flush_every` results.
+    """
+
+    def __init__(self, path, flush_every=64):
+        self.path = path
+        self.flush_every = flush_every
+        self.done = {}
+        self._partial_tail = False
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self._partial_tail = not line.endswith("\n")
+                    try:
+                        self.done.update(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A crash can leave the last line half written
+                        pass
+        self._f = None
+        self._pending = 0
+
+    def __enter__(self):
+        self._f = open(self.path, "a", encoding="utf-8")
+        if self._partial_tail:
+            # Terminate the half-written line so the next result starts on its own line
+            self._f.write("\n")
+        return self
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+    def add(self, hadm_id, answer):
+        self.done[hadm_id] = answer
+        self._f.write(json.dumps({hadm_id: answer}, ensure_ascii=False) + "\n")
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self._f.flush()
+            self._pending = 0
+
+
+def run_rows(process, records, checkpoint_path, concurrency):
+    """
+    Run process(row) -> (hadm_id, answer) over the records and return {hadm_id: answer} of every finished row.
+    Requests are issued concurrently since each call is network-bound. Finished rows are checkpointed as they
+    complete, and rows already in the checkpoint are skipped on a rerun.
+    """
+    with ResultCheckpoint(checkpoint_path) as checkpoint:
+        pending = [row for row in records if row["hadm_id"] not in checkpoint.done]
+        print(f"{len(checkpoint.done)} rows restored from checkpoint, {len(pending)} to go")
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for hadm_id, answer in executor.map(process, pending):
+                checkpoint.add(hadm_id, answer)
+    return checkpoint.done
+
+
+def add_llm_args(parser, concurrency=True):
+    """
+    Add the command line options shared by the LLM scripts: the vLLM server URL, the response cache, the log level
+    and, unless concurrency is False (the pipeline sets one per stage), the number of concurrent requests.
+    """
+    parser.add_argument("--vllm_base_url", type=str, default="http://localhost:8000/v1", help="OpenAI-compatible vLLM server used with --model_api_type vllm_server")
+    if concurrency:
+        parser.add_argument("--concurrency", type=int, default=8, help="number of concurrent LLM requests")
+    parser.add_argument("--cache_dir", type=str, default="./.llm_cache", help="directory of cached LLM responses")
+    parser.add_argument("--no_cache", action="store_true", help="always call the LLM instead of reusing cached responses")
+    parser.add_argument("--verbose", action="store_true", help="log the full prompts (DEBUG level)")
+
+
+_FORMATTER = string.Formatter()
+_FIELD_KEY_RE = re.compile(r"[^.\[]*")
+
+
+def _format_field(row, field_name, conversion, format_spec):
+    """
+    Render one replacement field exactly as str.format would (attribute/index lookups, !r, format specs).
+    """
+    value, _ = _FORMATTER.get_field(field_name, (), row)
+    return _FORMATTER.format_field(_FORMATTER.convert_field(value, conversion), format_spec)
+
+
+_JINJA_ENV = jinja2.Environment(undefined=jinja2.StrictUndefined, keep_trailing_newline=True)
+_JINJA_ENV.filters["format_field"] = _format_field
+
+
+@functools.lru_cache(maxsize=16)
+def compile_prompt_template(template):
+    """
+    Compile a str.format style prompt template into a Jinja2 template, rendered with `render(row=row)`.
+    Literal text is wrapped in raw blocks and plain {name} fields become row lookups; fields with
+    conversions, format specs or attribute/index access go through str.format's own field formatting.
+    Compiled templates are cached on the template text.
+    """
+    parts = []
+    for literal, field_name, format_spec, conversion in _FORMATTER.parse(template):
+        if literal:
+            parts.append("{% raw %}" + literal + "{% endraw %}")
+        if field_name is None:
+            continue
+        if field_name.isidentifier() and not format_spec and not conversion:
+            parts.append("{{ row[%r] }}" % field_name)
+        else:
+            parts.append("{{ row | format_field(%r, %r, %r) }}" % (field_name, conversion, format_spec))
+    return _JINJA_ENV.from_string("".join(parts))
+
+
+_JSON_DECODER = json.JSONDecoder()
+_BRACES_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def parse_answer(output):
+    """
+    Parse the JSON object in an LLM output.
+    The object starting at the first "{" is decoded in a single pass. Outputs that are not valid JSON
+    (e.g. Python literals with single quotes) fall back to ast.literal_eval of the text between the
+    outermost braces, normalized to JSON types; if that fails too, the braces text itself is returned.
+    """
+    start = output.find("{")
+    if start != -1:
+        try:
+            answer, _ = _JSON_DECODER.raw_decode(output, start)
+            return answer
+        except json.JSONDecodeError:
+            pass
+
+    match = _BRACES_RE.search(output)
+    if match is None:
+        raise ValueError(f"No JSON object in LLM output: {output!r}")
+    output = match.group()
+    try:
+        # The round trip turns tuples into lists and non-string keys into strings, as json.load would give
+        return json.loads(json.dumps(ast.literal_eval(output)))
+    except Exception:
+        return output
+
+
+def build_messages(row, system_prompt, user_prompt_template):
+    """
+    Render the user prompt for a row and return the chat messages.
+    """
+    try:
+        user_prompt = compile_prompt_template(user_prompt_template).render(row=row)
+    except jinja2.UndefinedError as e:
+        raise KeyError(f"Missing keys in row {row['hadm_id']}: {e.message}") from e
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+
+
+def call_llm(hadm_id, messages, client, model, args, cache=None):
+    """
+    Send the messages of one row to the LLM and return the parsed answer.
+    The output of an identical earlier request is reused if it is in the cache. Every log line carries the
+    hadm_id, since rows are processed concurrently and their lines interleave.
+    """
+    # Only a digest of the prompt is logged per row; the full messages are dumped at DEBUG level (--verbose)
+    logging.info(f"{hadm_id}: prompt {prompt_digest(messages)} to {args.model}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for message in messages:
+            logging.debug(f"{hadm_id}:\t{message['role']}: {message['content']}")
+
+    model_name = model if isinstance(model, str) else args.model
+    cache_key = ResponseCache.make_key(model_name, messages, args.temperature, args.random_seed, args.thinking_budget)
+    output = cache.get(cache_key) if cache is not None else None
+    if output is None:
+        response_cur = client(model=model, message=messages, temperature=args.temperature, seed=args.random_seed, thinking_budget=args.thinking_budget)
+        output = get_answer(response_cur)
+        if cache is not None:
+            cache.set(cache_key, output)
+
+    logging.info(f"GPT Output ({hadm_id}):\n " + output + "\n")
+    return parse_answer(output)
+
+
+class OpenAIServerClient:
+    """
+    Client for a long-running OpenAI-compatible server, e.g. one started with
+    `python -m vllm.entrypoints.openai.api_server --model <model>`, so the model is loaded once and shared by every script.
+    Called like the clients returned by models.get_response_method; the response is a regular chat completion.
+    """
+
+    def __init__(self, base_url, api_key="EMPTY"):
+        self.client = OpenAI(base_url=base_url, api_key=api_key)
+
+    def served_model(self):
+        """
+        Return the name of the model the server is serving.
+        """
+        return self.client.models.list().data[0].id
+
+    def __call__(self, model, message, temperature, seed, thinking_budget=None):
+        return self.client.chat.completions.create(model=model, messages=message, temperature=temperature, seed=seed)
+
+
+def make_client(args):
+    """
+    Set up the LLM client for args.model_api_type and return (client, model), where model is what the client is called with.
+    """
+    if args.model_api_type == "vllm_server":
+        # The model stays loaded in the server across scripts and runs
+        client = OpenAIServerClient(args.vllm_base_url)
+        return client, client.served_model()
+    client = get_response_method(args.model_api_type)
+    model = vllm_model_setup(args.model) if "vllm" in args.model else args.model
+    return client, model
+
+
+def run_openai_batch(requests, model, temperature, seed, poll_interval=60):
+    """
+    Send chat requests as one OpenAI Batch API job, wait for it to finish and return {custom_id: output text}.
+    `requests` maps a custom id (the hadm_id) to its messages. The client is configured from the
+    environment (OPENAI_API_KEY, OPENAI_BASE_URL). Requests that failed inside the batch are logged and left out.
+    """
+    client = OpenAI()
+    lines = [
+        json.dumps(
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": model, "messages": messages, "temperature": temperature, "seed": seed},
+            },
+            ensure_ascii=False,
+        )
+        for custom_id, messages in requests.items()
+    ]
+    input_file = client.files.create(file=("batch_input.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    print(f"Submitted batch {batch.id} with {len(lines)} requests")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+        logging.info(f"Batch {batch.id}: {batch.status} {batch.request_counts}")
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+    outputs = {}
+    if batch.output_file_id is None:
+        return outputs
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            logging.warning(f"Batch request {result['custom_id']} failed: {result.get('error') or response}")
+            continue
+        outputs[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return outputs
+
+
+def template_fields(template):
+    """
+    Return the set of row keys referenced by a str.format template (the part of each field before any "." or "[").
+    """
+    return {_FIELD_KEY_RE.match(field).group() for _, field, _, _ in _FORMATTER.parse(template) if field}
+
+
+def check_template_fields(template, columns):
+    """
+    Raise a KeyError listing the template fields that are not among the columns.
+    Done once before dispatching the rows, since every record of a frame has the same keys.
+    """
+    missing = template_fields(template) - set(columns)
+    if missing:
+        raise KeyError(f"Missing keys for the prompt template: {sorted(missing)}")
+
+
+def read_sample_df(data_dir, columns=None):
+    """
+    Load sample_df.csv from data_dir, keeping only the given columns (all columns if None).
+    The CSV is parsed once (with the C engine, since the note text in it has quoted line breaks) and a Parquet
+    copy is written next to it; later loads read the Parquet copy as long as it is newer than the CSV.
+    """
+    csv_path = os.path.join(data_dir, "sample_df.csv")
+    parquet_path = os.path.join(data_dir, "sample_df.parquet")
+    if not os.path.exists(parquet_path) or os.path.getmtime(parquet_path) < os.path.getmtime(csv_path):
+        df = pd.read_csv(csv_path, dtype={"hadm_id": str})
+        df.to_parquet(parquet_path, index=False)
+    if columns is not None:
+        # Columns missing from the file are left for the prompt formatting to report
+        available = set(pq.read_schema(parquet_path).names)
+        columns = [c for c in columns if c in available]
+    df = pd.read_parquet(parquet_path, columns=columns)
+    # Parquet reads missing values of text columns back as None; restore the NaN read_csv gives,
+    # so they are rendered in the prompts as before
+    obj_columns = df.select_dtypes(object).columns
+    df[obj_columns] = df[obj_columns].where(df[obj_columns].notna(), np.nan)
+    return df
+
+
+def load_or_build_frame(cache_path, input_paths, build, params=None):
+    """
+    Return the DataFrame produced by build(), reusing a copy stored at cache_path while none of input_paths
+    changed. The inputs' mtimes and sizes, together with any JSON-serializable params that also shape the
+    frame (e.g. the selected columns), are hashed into a key kept in a JSON sidecar (cache_path + ".json").
+    The frame is stored with pickle rather than Parquet, because the merged columns hold lists and dicts that
+    Parquet would read back as numpy arrays and so change how they are rendered in the prompts.
+    """
+    stats = [[path, os.path.getmtime(path), os.path.getsize(path)] for path in input_paths]
+    key = hashlib.sha256(json.dumps([stats, params]).encode("utf-8")).hexdigest()
+    meta_path = f"{cache_path}.json"
+    try:
+        with open(meta_path, "r") as f:
+            if json.load(f)["key"] == key:
+                return pd.read_pickle(cache_path)
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    df = build()
+    df.to_pickle(cache_path)
+    with open(meta_path, "w") as f:
+        json.dump({"key": key, "inputs": stats}, f, indent=4)
+    return df
@@ -1,18 +1,13 @@
 import os
 import sys
 import json
-import random
 import pickle
+import itertools
 import argparse
 import numpy as np
 import pandas as pd
 
 
-def set_seed(seed):
-    random.seed(seed)
-    np.random.seed(seed)
-
-
 def load_pickle(data_path):
     """
     Load a pickle file from the given data path.
@@ -24,35 +19,52 @@ def load_pickle(data_path):
     return data
 
 
-def save_to_json(data, output_file):
+def save_to_json(df, output_file):
     """
-    Save the given data to a JSON file with pretty formatting.
+    Save the rows of df as a list of records to a JSON file with pretty formatting.
     """
     print(f"Saving data to JSON file: {output_file}")
     with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+        json.dump(df.to_dict("records"), f, ensure_ascii=False, indent=4)
     print("Data saved to JSON successfully.")
 
 
-def sample_words(words, num_sample):
-    if len(words) >= num_sample:
-        sampled = random.sample(words, num_sample)
+def sample_words(words, n, num_sample, rng):
+    """
+    Draw num_sample distinct words for each of n rows at once and join each draw into a comma-separated string.
+    Only num_sample indices are drawn per row. When the vocabulary is large enough for repeats to be rare, every
+    row is drawn with replacement in one call and the rows that got a repeated word are drawn again; small
+    vocabularies are drawn row by row without replacement.
+    """
+    if len(words) < num_sample:
+        return [", ".join(words)] * n
+    word_arr = np.fromiter(words, dtype=object, count=len(words))
+    num_words = len(word_arr)
+    if num_sample * num_sample > num_words:
+        idx = np.array([rng.choice(num_words, num_sample, replace=False) for _ in range(n)], dtype=np.int64).reshape(n, num_sample)
     else:
-        sampled = words
-    return ", ".join(sampled)
+        idx = rng.integers(0, num_words, (n, num_sample))
+        redraw = np.arange(n)
+        while len(redraw):
+            # A row has a repeat if two of its sorted indices are equal
+            sorted_idx = np.sort(idx[redraw], axis=1)
+            redraw = redraw[(sorted_idx[:, 1:] == sorted_idx[:, :-1]).any(axis=1)]
+            idx[redraw] = rng.integers(0, num_words, (len(redraw), num_sample))
+    return list(map(", ".join, word_arr[idx].tolist()))
+
 
-def create_sampled_columns(df, word_dict, word_type, num_sample):
+def create_sampled_columns(df, word_dict, word_type, num_sample, rng):
     columns = {}
     n = len(df)
     for level, words in word_dict.items():
         col_name = f"{word_type}_{level}"
-        columns[col_name] = [sample_words(words, num_sample) for _ in range(n)]
+        columns[col_name] = sample_words(words, n, num_sample, rng)
     return pd.DataFrame(columns, index=df.index)
 
 
 def main(args):
     # Seed fix
-    set_seed(args.random_seed)
+    rng = np.random.default_rng(args.random_seed)
 
     # Data load
     data_path = os.path.join(args.data_dir, f"{args.data_file_name}.json")
@@ -66,18 +78,19 @@ def main(args):
 
     cefr_word_df = pd.read_csv(cefr_data_path)
     medterm_dict = json.load(open(medterm_dict_path))
-    medterm_list = set(word.lower() for words in medterm_dict.values() for word in words)
-    
-    cefr_word_df['headword'] = cefr_word_df['headword'].str.lower()
-    cefr_cnt = cefr_word_df.groupby("headword").nunique()
-    valid_headwords = cefr_cnt[cefr_cnt.CEFR == 1].index
-
-    cefr_word_df = cefr_word_df[
-        cefr_word_df['headword'].isin(valid_headwords) &
+    medterm_list = frozenset(word.lower() for word in itertools.chain.from_iterable(medterm_dict.values()))
+
+    # Lowercase once, then work on categorical codes so the groupby and isin below compare integers, not strings
+    cefr_word_df['headword'] = cefr_word_df['headword'].str.lower().astype("category")
+    # Keep headwords with a single CEFR level, longer than 3 characters and not a medical term
+    cefr_cnt = cefr_word_df.groupby("headword", observed=True)["CEFR"].nunique()
+    mask = (
+        cefr_word_df['headword'].map(cefr_cnt).eq(1) &
         (cefr_word_df['headword'].str.len() > 3) &
         ~cefr_word_df['headword'].isin(medterm_list)
-    ]
-    cefr_word_dict = cefr_word_df.groupby("CEFR")["headword"].unique().apply(list).to_dict()
+    )
+    cefr_word_df = cefr_word_df.loc[mask]
+    cefr_word_dict = cefr_word_df.drop_duplicates(["CEFR", "headword"]).groupby("CEFR")["headword"].apply(list).to_dict()
 
     print("Statistic of CEFR general vocabs")
     print(cefr_word_df.groupby("CEFR")["headword"].nunique())
@@ -87,13 +100,13 @@ def main(args):
         print(key, ": ", len(set(val)))
 
     # Mapping randomly sampled words per sample
-    cefr_sampled_words_df = create_sampled_columns(sample_df, cefr_word_dict, "cefr", args.num_sample)
-    med_sampled_words_df = create_sampled_columns(sample_df, medterm_dict, "med", args.num_sample)
+    cefr_sampled_words_df = create_sampled_columns(sample_df, cefr_word_dict, "cefr", args.num_sample, rng)
+    med_sampled_words_df = create_sampled_columns(sample_df, medterm_dict, "med", args.num_sample, rng)
     sample_df = pd.concat([sample_df, cefr_sampled_words_df, med_sampled_words_df], axis=1)
 
     # Save the results
     output_path = os.path.join(args.data_dir, f"{args.data_file_name}_w_cefr.json")
-    save_to_json(sample_df.to_dict("records"), output_path)
+    save_to_json(sample_df, output_path)
 
     print(f"Sampled data saved to {output_path}")
 
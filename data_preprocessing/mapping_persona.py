@@ -1,96 +1,96 @@
 import os
 import json
-import random
 import argparse
 import numpy as np
 import pandas as pd
-from itertools import product
+from itertools import product, permutations
 
 
-def set_seed(seed):
-    random.seed(seed)
-    np.random.seed(seed)
-
-
-def save_to_json(data, output_file):
+def save_to_json(df, output_file):
     with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
+        json.dump(df.to_dict("records"), f, ensure_ascii=False, indent=4)
+
+
+def random_sample_diag(df, num_samples, rng):
+    """
+    Sample num_samples hadm_ids spread as evenly as possible across diagnoses.
+    The per-diagnosis counts are settled first by water-filling: every diagnosis gets an equal share capped at
+    its number of samples, and what the capped ones cannot take is shared out again among the rest
+    (the last few one each, to randomly chosen diagnoses). Each diagnosis is then sampled exactly once.
+    """
+    # hadm_ids per diagnosis, computed once instead of a boolean scan of df per lookup
+    diag_ids = {diag: ids.to_numpy() for diag, ids in df.groupby('diagnosis', observed=True)['hadm_id']}
+    diagnosis_values = sorted(diag_ids)
+    caps = np.array([len(diag_ids[diag]) for diag in diagnosis_values])
+    if num_samples > caps.sum():
+        raise ValueError(f"Could not find enough samples to reach target of {num_samples} (only {caps.sum()} available)")
 
-def random_sample_diag(df, num_samples, random_seed=42):
-    diagnosis_values = sorted(df['diagnosis'].unique())
     num_samples_per_diagnosis = num_samples // len(diagnosis_values)
-    allocation = {diag: num_samples_per_diagnosis for diag in diagnosis_values}
-    remaining_capacity = {}
+    for diag, cap in zip(diagnosis_values, caps):
+        if cap < num_samples_per_diagnosis:
+            print(f"Warning: Only {cap} samples available for diagnosis '{diag}' (requested {num_samples_per_diagnosis})")
+
+    allocation = np.zeros(len(diagnosis_values), dtype=np.int64)
+    remaining = num_samples
+    while remaining > 0:
+        open_diags = np.flatnonzero(allocation < caps)
+        share = remaining // len(open_diags)
+        if share == 0:
+            allocation[rng.choice(open_diags, size=remaining, replace=False)] += 1
+            break
+        added = np.minimum(caps[open_diags] - allocation[open_diags], share)
+        allocation[open_diags] += added
+        remaining -= added.sum()
 
     selected_samples = []
-    for diagnosis, count in allocation.items():
-        diag_df = df[df['diagnosis'] == diagnosis]
-        if len(diag_df) >= count:
-            samples = diag_df.sample(count, random_state=random_seed)['hadm_id'].tolist()
-        else:
-            samples = diag_df['hadm_id'].tolist()
-            print(f"Warning: Only {len(samples)} samples available for diagnosis '{diagnosis}' (requested {count})")
-        selected_samples.extend(samples)
-        remaining_capacity[diagnosis] = len(diag_df) - len(samples)
-
-    if len(selected_samples) < num_samples:
-        remaining = num_samples - len(selected_samples)
-        extra_df = df[~df['hadm_id'].isin(selected_samples)]
-        diags_extra = [d for d, cap in remaining_capacity.items() if cap > 0]
-        if diags_extra:
-            base_extra = remaining // len(diags_extra)
-            leftover = remaining % len(diags_extra)
-            extra_alloc = {d: min(cap, base_extra) for d, cap in remaining_capacity.items() if cap > 0}
-            for d in np.random.permutation(diags_extra)[:leftover]:
-                if extra_alloc[d] < remaining_capacity[d]:
-                    extra_alloc[d] += 1
-                    
-            for diag, n_extra in extra_alloc.items():
-                if n_extra > 0:
-                    diag_df = df[(df['diagnosis'] == diag) & (~df['hadm_id'].isin(selected_samples))]
-                    extra_ids = diag_df.sample(n_extra, random_state=random_seed)['hadm_id'].tolist()
-                    selected_samples.extend(extra_ids)
-                    
-        remaining = num_samples - len(selected_samples)
-        extra_df = df[~df['hadm_id'].isin(selected_samples)]
-        if len(extra_df) >= remaining:
-            extra_samples = extra_df.sample(remaining, random_state=args.random_seed)['hadm_id'].tolist()
-            selected_samples.extend(extra_samples)
-        else:
-            print(f"Warning: Could not find enough samples to reach target of {num_samples}")
+    for diag, count in zip(diagnosis_values, allocation):
+        selected_samples.extend(rng.choice(diag_ids[diag], size=count, replace=False).tolist())
     assert (len(set(selected_samples)) == num_samples)
     return selected_samples
 
 
-def assign_labelers_balanced(df, labelers, k=1, random_seed=42):
-    total_counts = {l: 0 for l in labelers}
-    diag_counts  = {diag: {l: 0 for l in labelers} for diag in df['diagnosis'].unique()}
+def assign_labelers_balanced(df, labelers, rng, k=1):
+    """
+    Assign k distinct labelers to every sample by dealing labelers round-robin over a diagnosis-stratified shuffle.
+    Rows are shuffled within each diagnosis and the diagnoses are laid out one after another, so consecutive
+    labelers cover each diagnosis evenly and every labeler ends up with exactly len(df) * k / len(labelers) samples.
+    """
     assert len(df) % len(labelers) == 0, "No labelers provided"
-    assignment = {}
-    df_shuf = df.sample(frac=1, random_state=random_seed).reset_index(drop=True)
-    for _, row in df_shuf.iterrows():
-        hid  = row['hadm_id']
-        diag = row['diagnosis']
-        candidates = sorted(labelers, key=lambda l: (diag_counts[diag][l], total_counts[l], random.random()))
-        chosen = candidates[:k]
-        assignment[hid] = chosen if k > 1 else chosen[0]
-        for l in chosen:
-            diag_counts[diag][l] += 1
-            total_counts[l] += 1
-
-    return assignment
-
-
-def assign_labelers_unique_per_group(df, labelers, random_seed=None):
-    total_counts = {l: 0 for l in labelers}
-    diag_counts  = {diag: {l: 0 for l in labelers} for diag in df['diagnosis'].unique()}
+    # Sort by diagnosis code with a random key as the tie-breaker: one lexsort instead of a shuffle per diagnosis group
+    diag_codes, _ = pd.factorize(df['diagnosis'], sort=True)
+    order = np.lexsort((rng.random(len(df)), diag_codes))
+    hadm_ids = df['hadm_id'].to_numpy()[order].tolist()
+
+    labeler_arr = rng.permutation(np.asarray(labelers, dtype=object))
+    # Sample i gets labelers i*k, ..., i*k + k - 1 (mod number of labelers)
+    slots = (np.arange(len(hadm_ids))[:, None] * k + np.arange(k)[None, :]) % len(labeler_arr)
+    chosen = labeler_arr[slots[:, 0]].tolist() if k == 1 else labeler_arr[slots].tolist()
+    return dict(zip(hadm_ids, chosen))
+
+
+def assign_labelers_unique_per_group(df, labelers, rng):
+    """
+    Assign one labeler per sample so that no labeler gets two samples of the same persona combination,
+    every labeler gets the same number of samples, and diagnoses are spread evenly across labelers.
+    Each combination group is solved exactly by scoring every assignment of its samples to the labelers
+    with quota left, preferring labelers with fewer samples of that diagnosis, then fewer samples overall.
+    """
     assert len(df) % len(labelers) == 0, "No labelers provided"
     quota = len(df) // len(labelers)
     df = df.copy()
-    df['labeler'] = None
-    for combo, group in df.groupby(['personality', 'cefr', 'recall_level']):
-        m = len(group)
+
+    # Work on integer codes: counters are dense arrays and each group's candidate assignments are scored in one numpy step
+    diag_codes, diag_values = pd.factorize(df['diagnosis'])
+    combo_codes = df.groupby(['personality', 'cefr', 'recall_level'], observed=True).ngroup().to_numpy()
+    combos = df[['personality', 'cefr', 'recall_level']].to_numpy()
+    total_counts = np.zeros(len(labelers), dtype=np.int64)
+    diag_counts = np.zeros((len(diag_values), len(labelers)), dtype=np.int64)
+    result = np.empty(len(df), dtype=np.int64)
+
+    order = np.argsort(combo_codes, kind='stable')
+    for rows in np.split(order, np.flatnonzero(np.diff(combo_codes[order])) + 1):
+        combo = tuple(combos[rows[0]])
+        m = len(rows)
         if m > len(labelers):
             raise ValueError(
                 f"There are {m} samples for combination {combo}, "
@@ -98,29 +98,28 @@ def assign_labelers_unique_per_group(df, labelers, random_seed=None):
                 "cannot assign uniquely."
             )
 
-        used_in_group = set()
-        group = group.sample(frac=1, random_state=random_seed)
-        for idx, row in group.iterrows():
-            diag = row['diagnosis']
-            candidates = [
-                l for l in labelers
-                if l not in used_in_group and total_counts[l] < quota
-            ]
-            if not candidates:
-                raise ValueError(f"No candidates available for assignment for comb '{combo}'")
-            candidates.sort(key=lambda l: (diag_counts[diag][l], total_counts[l], random.random()))
-            chosen = candidates[0]
-            df.at[idx, 'labeler'] = chosen
-            used_in_group.add(chosen)
-            total_counts[chosen]  += 1
-            diag_counts[diag][chosen] += 1
-    assert all(c == quota for c in total_counts.values()), "Labeler counts are not balanced across diagnoses"
+        candidates = np.flatnonzero(total_counts < quota)
+        if len(candidates) < m:
+            raise ValueError(f"No candidates available for assignment for comb '{combo}'")
+        diags = diag_codes[rows]
+        # Diagnoses of the group in first-seen order, and each sample's row in the cost table
+        sample_diag, group_diags = pd.factorize(diags)
+        # Diagnosis counts dominate the cost, total counts break ties, and the random jitter breaks the rest
+        cost = diag_counts[np.ix_(group_diags, candidates)] * (quota + 1) + total_counts[candidates] + rng.random((len(group_diags), len(candidates)))
+        perms = np.array(list(permutations(range(len(candidates)), m)))
+        best = candidates[perms[cost[sample_diag, perms].sum(axis=1).argmin()]]
+        result[rows] = best
+        total_counts[best] += 1
+        diag_counts[diags, best] += 1
+    # Assign all labelers at once instead of a df.at write per row
+    df['labeler'] = pd.Categorical.from_codes(result, labelers)
+    assert (total_counts == quota).all(), "Labeler counts are not balanced across diagnoses"
     return df
 
     
 def main(args):
-    # Seed fix
-    set_seed(args.random_seed)
+    # One generator is shared by every sampling step below
+    rng = np.random.default_rng(args.random_seed)
 
     # Set up options
     labelers = ['A', 'B', 'C', 'D']
@@ -139,33 +138,37 @@ def main(args):
     # Data load
     data_path = os.path.join(args.data_dir, f"{args.data_file_name}.json")
     sample_df = pd.read_json(data_path, dtype={"hadm_id": str})
+    # Low-cardinality columns are grouped and filtered on repeatedly, so keep them as integer-coded categoricals
+    for col in ("diagnosis", "gender", "arrival_transport"):
+        sample_df[col] = sample_df[col].astype("category")
     print(sample_df.shape)
     print(sample_df.hadm_id.nunique())
     print(sample_df['diagnosis'].value_counts())
     print()
     print(sample_df['gender'].value_counts())
 
+    # Every sample's split is tracked in one column, and the pools of samples still to draw from are masks over it
+    sample_df["split"] = "unassigned"
+
     # Sampled Valid Dataset
     num_valid_samples = len(sample_df) - num_total_info_sample - num_total_persona_sample
-    valid_samples = random_sample_diag(sample_df, num_valid_samples)
-    valid_df = sample_df[sample_df['hadm_id'].isin(valid_samples)].copy()
-    valid_df["split"] = "valid"
+    valid_samples = random_sample_diag(sample_df, num_valid_samples, rng)
+    sample_df.loc[sample_df['hadm_id'].isin(valid_samples), "split"] = "valid"
+    valid_df = sample_df[sample_df['split'] == "valid"]
     print(f"valid samples: {len(valid_df)}")
     print(valid_df['diagnosis'].value_counts())
 
     # Sampled info Dataset
-    sample_df_wo_valid = sample_df[~sample_df['hadm_id'].isin(valid_samples)].copy()
-    info_samples = random_sample_diag(sample_df_wo_valid, num_total_info_sample)
-    info_df = sample_df_wo_valid[sample_df_wo_valid['hadm_id'].isin(info_samples)].copy()
+    sample_df_wo_valid = sample_df[sample_df['split'] == "unassigned"]
+    info_samples = random_sample_diag(sample_df_wo_valid, num_total_info_sample, rng)
+    sample_df.loc[sample_df['hadm_id'].isin(info_samples), "split"] = "info"
+    info_df = sample_df[sample_df['split'] == "info"].copy()
     print(f"Total info samples: {len(info_samples)}")
     print(info_df['diagnosis'].value_counts())
 
     # Assigned labelers for info
-    info_hadm_ids = info_df['hadm_id'].tolist()
-    info_hadm_ids = np.random.permutation(info_hadm_ids)
-    strat_map = assign_labelers_balanced(info_df[['hadm_id', 'diagnosis']], labelers, k=num_labeler_per_info_sample, random_seed=args.random_seed)
-    info_df['assigned_labelers'] = info_df['hadm_id'].map(lambda hid: strat_map[hid])
-    info_df["split"] = "info"
+    strat_map = assign_labelers_balanced(info_df[['hadm_id', 'diagnosis']], labelers, rng, k=num_labeler_per_info_sample)
+    info_df['assigned_labelers'] = info_df['hadm_id'].map(strat_map)
 
     for labeler in labelers:
         labeler_df = info_df[
@@ -173,40 +176,43 @@ def main(args):
                         .apply(lambda labs: labeler in labs)
         ]
         
-        save_to_json(labeler_df.to_dict("records"), os.path.join(args.save_dir, "per_labeler", f"info_{labeler}.json"))
+        save_to_json(labeler_df, os.path.join(args.save_dir, "per_labeler", f"info_{labeler}.json"))
         print(labeler_df.shape)
         print(labeler_df.diagnosis.value_counts())
 
     # Sampled persona Dataset (Dazed)
-    dazed_df = sample_df[sample_df['arrival_transport'] == 'AMBULANCE']
-    available_dazed_df = dazed_df[~dazed_df['hadm_id'].isin(info_samples + valid_samples)].copy()
-    dazed_sampleds = random_sample_diag(available_dazed_df, num_total_dazed_sample)
-    dazed_persona_df = sample_df[sample_df['hadm_id'].isin(dazed_sampleds)].copy()
-    dazed_persona_df["split"] = "persona"
+    is_ambulance = sample_df['arrival_transport'] == 'AMBULANCE'
+    available_dazed_df = sample_df[is_ambulance & (sample_df['split'] == "unassigned")]
+    dazed_sampleds = random_sample_diag(available_dazed_df, num_total_dazed_sample, rng)
+    is_dazed = sample_df['hadm_id'].isin(dazed_sampleds)
+    sample_df.loc[is_dazed, "split"] = "persona"
+    dazed_persona_df = sample_df[is_dazed].copy()
     dazed_persona_df["personality"] = "plain"
     dazed_persona_df["cefr"] = "B"
     dazed_persona_df["recall_level"] = "high"
     dazed_persona_df["dazed_level"] = "high"
 
     # Assigned labelers for dazed
-    strat_map_dazed_persona = assign_labelers_balanced(dazed_persona_df[['hadm_id', 'diagnosis']], labelers, k=1, random_seed=args.random_seed)
-    dazed_persona_df['labeler'] = dazed_persona_df['hadm_id'].map(lambda hid: strat_map_dazed_persona[hid])
-    print(f"Dazed samples: {len(dazed_persona_df)}/{len(available_dazed_df)}/{len(dazed_df)}")
+    strat_map_dazed_persona = assign_labelers_balanced(dazed_persona_df[['hadm_id', 'diagnosis']], labelers, rng, k=1)
+    dazed_persona_df['labeler'] = dazed_persona_df['hadm_id'].map(strat_map_dazed_persona)
+    print(f"Dazed samples: {len(dazed_persona_df)}/{len(available_dazed_df)}/{is_ambulance.sum()}")
     print(available_dazed_df['diagnosis'].value_counts())
     print(dazed_persona_df['diagnosis'].value_counts())
     print(dazed_persona_df.groupby('labeler')['diagnosis'].value_counts())
 
     # Sampled persona Dataset (Non-Dazed)
-    remaining_df = sample_df[~sample_df['hadm_id'].isin(info_samples + valid_samples + dazed_sampleds)].copy()
-    persona_samples = random_sample_diag(remaining_df, num_total_persona_sample - num_total_dazed_sample)
-    persona_df = sample_df[sample_df['hadm_id'].isin(persona_samples)].copy()
+    remaining_df = sample_df[sample_df['split'] == "unassigned"]
+    persona_samples = random_sample_diag(remaining_df, num_total_persona_sample - num_total_dazed_sample, rng)
+    is_persona = sample_df['hadm_id'].isin(persona_samples)
+    sample_df.loc[is_persona, "split"] = "persona"
+    persona_df = sample_df[is_persona].copy()
     print(f"Total persona samples: {len(persona_samples)}")
     print(remaining_df['diagnosis'].value_counts())
     print(dazed_persona_df['diagnosis'].value_counts())
 
     # Randomly assigned personality, CEFR, recall
     persona_hadm_ids = persona_df['hadm_id'].tolist()
-    persona_hadm_ids = np.random.permutation(persona_hadm_ids)
+    persona_hadm_ids = rng.permutation(persona_hadm_ids)
     comb_options = list(product(personality_options, cefr_options, recall_options))
     repeats_per_comb = len(persona_hadm_ids) // num_comb
     remainder = len(persona_hadm_ids) % num_comb
@@ -215,37 +221,40 @@ def main(args):
     for i, combo in enumerate(comb_options):
         count = repeats_per_comb + (1 if i < remainder else 0)
         assignments.extend([combo] * count)
-    assignments = np.random.permutation(assignments)
+    assignments = rng.permutation(assignments)
     assert len(assignments) == len(persona_hadm_ids)
 
-    mapping = dict(zip(persona_hadm_ids, assignments))
-    persona_df["split"] = "persona"
-    persona_df['personality'] = persona_df['hadm_id'].map(lambda x: mapping[x][0])
-    persona_df['cefr'] = persona_df['hadm_id'].map(lambda x: mapping[x][1])
-    persona_df['recall_level'] = persona_df['hadm_id'].map(lambda x: mapping[x][2])
+    # One plain dict per attribute, so Series.map does a hash lookup per row instead of calling a lambda
+    for i, col in enumerate(('personality', 'cefr', 'recall_level')):
+        persona_df[col] = persona_df['hadm_id'].map(dict(zip(persona_hadm_ids, assignments[:, i])))
     persona_df["dazed_level"] = "normal"
+    for col in ('personality', 'cefr', 'recall_level'):
+        persona_df[col] = persona_df[col].astype('category')
 
     # Assign labelers for persona
-    persona_df = assign_labelers_unique_per_group(persona_df, labelers, random_seed=args.random_seed)
-    print(persona_df.groupby('labeler').diagnosis.nunique().value_counts())
-    print(persona_df.groupby(['personality', 'cefr', 'recall_level']).labeler.nunique().value_counts())
+    persona_df = assign_labelers_unique_per_group(persona_df, labelers, rng)
+    print(persona_df.groupby('labeler', observed=True).diagnosis.nunique().value_counts())
+    print(persona_df.groupby(['personality', 'cefr', 'recall_level'], observed=True).labeler.nunique().value_counts())
 
     for labeler in labelers:
         sub = persona_df[persona_df['labeler'] == labeler]
-        combo_counts = sub.groupby(['personality', 'cefr', 'recall_level']).size().sort_index()
+        combo_counts = sub.groupby(['personality', 'cefr', 'recall_level'], observed=True).size()
         print(f"\nLabeler '{labeler}'(size / # unique comb): ", sub.shape[0], len(combo_counts))
         print(combo_counts)
         print(sub["diagnosis"].value_counts())
         print('' + '-' * 50)
 
     persona_all_df = pd.concat([persona_df, dazed_persona_df], axis=0)
-    persona_all_df = persona_all_df.sample(frac=1, random_state=args.random_seed).reset_index(drop=True)
-    print(persona_all_df.groupby('labeler').diagnosis.nunique())
+    persona_all_df = persona_all_df.sample(frac=1, random_state=rng).reset_index(drop=True)
+    # concat falls back to object for categoricals whose categories differ, so cast the persona columns again
+    for col in ('personality', 'cefr', 'recall_level', 'labeler'):
+        persona_all_df[col] = persona_all_df[col].astype('category')
+    print(persona_all_df.groupby('labeler', observed=True).diagnosis.nunique())
     for labeler in labelers:
         sub = persona_all_df[persona_all_df['labeler'] == labeler]
-        combo_counts = sub.groupby(['personality', 'cefr', 'recall_level']).size().sort_index()
+        combo_counts = sub.groupby(['personality', 'cefr', 'recall_level'], observed=True).size()
         
-        save_to_json(sub.to_dict("records"), os.path.join(args.save_dir, "per_labeler", f"persona_{labeler}.json"))
+        save_to_json(sub, os.path.join(args.save_dir, "per_labeler", f"persona_{labeler}.json"))
         print(f"\nLabeler '{labeler}' (size / # unique comb): ", sub.shape[0], len(combo_counts))
         print(combo_counts)
         print('' + '-' * 50)
@@ -255,7 +264,7 @@ def main(args):
     persona_all_df.drop(columns=['labeler'], inplace=True)
     dazed_persona_df.drop(columns=['labeler'], inplace=True)
     all_df = pd.concat([info_df, valid_df, persona_all_df], axis=0)
-    save_to_json(persona_all_df.to_dict("records"), os.path.join(args.save_dir, f"patient_profile.json"))
+    save_to_json(persona_all_df, os.path.join(args.save_dir, f"patient_profile.json"))
 
 
 if __name__ == "__main__":
@@ -1,6 +1,27 @@
 import os
 import argparse
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.compute as pc
+from concurrent.futures import ThreadPoolExecutor
+
+
+SECTION_KEYS = [
+    "Allergies:",
+    "Attending:",
+    "Chief Complaint:",
+    "Complaint:",
+    "Major Surgical or Invasive Procedure:",
+    "History of Present Illness:",
+    "Past Medical History:",
+    "PMH:",
+    "Social History:",
+    "Family History:",
+    "Physical Exam:",
+    "Discharge exam:",
+]
 
 
 def print_statistic(df):
@@ -9,127 +30,143 @@ def print_statistic(df):
     print()
 
 
-def word_cnt_hpi(row):
-    return len(row["text"][row["hpi_index"] : row["pmh_index"]].split())
-
-
-def word_cnt(text):
-    if isinstance(text, str):
-        return len(text.split())
-    else:
-        0
-
-
-def split_section(row):
-    if (row["start_idx"] == -1) or (row["end_idx"] == -1):
-        return None
-    else:
-        return row["text"][row["start_idx"] : row["end_idx"]]
-
-
-def split_section_multi_key(row, start_key):
-    if (row["end_idx_1"] == -1) and (row["end_idx_2"] == -1):
-        return None
-    end_index = min(pos for pos in [row["end_idx_1"], row["end_idx_2"]] if pos != -1)
-    if (row["start_idx"] == -1) or (end_index == -1):
-        return None
-    else:
-        return row["text"][row["start_idx"] + len(start_key) : end_index]
+def print_filter_statistic(df, keep=None):
+    """
+    Print the id and word count statistics of the rows of df selected by the boolean mask keep (all rows if None).
+    """
+    if keep is not None:
+        df = df.loc[keep, ["subject_id", "hadm_id", "note_id", "hpi_word_cnt", "pmi_word_cnt", "total_word_cnt"]]
+    print_statistic(df)
+    print(df.hpi_word_cnt.describe())
+    print(df.pmi_word_cnt.describe())
+    print(df.total_word_cnt.describe())
+    print()
 
 
-def split_history_section(data_df, start_key, end_key1, endkey2):
-    data_df["start_idx"] = data_df.text.str.lower().str.find(start_key.lower())
-    data_df["end_idx_1"] = data_df.text.str.lower().str.find(end_key1.lower())
-    data_df["end_idx_2"] = data_df.text.str.lower().str.find(endkey2.lower())
-    data_df[start_key.replace(":", "")] = data_df.apply(lambda x: split_section_multi_key(x, start_key=start_key), axis=1)
-    data_df[start_key.replace(":", "")] = data_df[start_key.replace(":", "")].str.replace("\n", " ").str.strip()
+def read_notes(path, columns=("note_id", "subject_id", "hadm_id", "text")):
+    """
+    Read the given columns of a MIMIC-IV-Note csv with the multithreaded pyarrow parser, skipping the other columns.
+    pandas' pyarrow engine cannot parse the quoted multi-line note text, so the parser is called directly.
+    """
+    table = pa_csv.read_csv(
+        path,
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(include_columns=list(columns)),
+    )
+    return table.to_pandas()
+
+
+def slice_sections(texts, starts, ends):
+    """
+    Slice texts[i][starts[i]:ends[i]] for every note with newlines replaced by spaces and the ends stripped,
+    or None where either offset is -1. Cleaning each slice here avoids two more passes over the new column.
+    """
+    return [
+        None if (start == -1) or (end == -1) else text[start:end].replace("\n", " ").strip() for text, start, end in zip(texts, starts, ends)
+    ]
+
+
+def find_section_offsets(text_lc, keys, num_workers=None):
+    """
+    Return the first offset of every section key in the lowercased note texts (-1 if absent), one column per key.
+    Each distinct key is searched once, on text lowercased once by the caller. For pure-ASCII text the searches
+    run as pyarrow kernels on a thread pool, since those release the GIL; pyarrow reports byte offsets, so
+    text with non-ASCII characters falls back to pandas, which reports character offsets.
+    """
+    keys = list(dict.fromkeys(keys))
+    text_arr = pa.array(text_lc, from_pandas=True)
+    if pc.all(pc.string_is_ascii(text_arr)).as_py() is False:
+        return pd.DataFrame({key: text_lc.str.find(key.lower()) for key in keys}, index=text_lc.index)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        offsets = executor.map(lambda key: pc.find_substring(text_arr, key.lower()), keys)
+        return pd.DataFrame({key: pd.Series(offset.to_numpy(zero_copy_only=False), index=text_lc.index) for key, offset in zip(keys, offsets)})
+
+
+def split_history_section(data_df, texts, offsets, start_key, end_key1, endkey2):
+    start_idx = offsets[start_key].to_numpy()
+    end_idx_1 = offsets[end_key1].to_numpy()
+    end_idx_2 = offsets[endkey2].to_numpy()
+    # The section ends at whichever end key comes first
+    end_idx = np.where(end_idx_1 == -1, end_idx_2, np.where(end_idx_2 == -1, end_idx_1, np.minimum(end_idx_1, end_idx_2)))
+    start_idx = np.where(start_idx == -1, -1, start_idx + len(start_key))
+    col = start_key.replace(":", "")
+    data_df[col] = slice_sections(texts, start_idx.tolist(), end_idx.tolist())
     return data_df
 
 
 def main(args):
     # Load discharge summaries
     print("Load note dataframes...")
-    note_df = pd.read_csv(os.path.join(args.note_dir, "discharge.csv"))
+    note_df = read_notes(os.path.join(args.note_dir, "discharge.csv"))
     print_statistic(note_df)
     print()
 
+    # Offsets of all section headers, from a single lowercased copy of the text
+    text_lc = note_df.text.str.lower()
+    offsets = find_section_offsets(text_lc, SECTION_KEYS)
+
     # Filtering the note which contains minimum information about hpi, pmh
-    note_df["hpi_index"] = note_df.text.str.lower().str.find("History of Present Illness:".lower())
-    note_df["pmh_index"] = note_df.text.str.lower().str.find("Past Medical History:".lower())
-    note_df["word_cnt"] = note_df.apply(word_cnt, axis=1)
-    note_df = note_df[(note_df.hpi_index > 0) & (note_df.pmh_index > 0)]
+    note_df["hpi_index"] = offsets["History of Present Illness:"]
+    note_df["pmh_index"] = offsets["Past Medical History:"]
+    keep = (note_df.hpi_index > 0) & (note_df.pmh_index > 0)
+    note_df = note_df[keep]
+    text_lc = text_lc[keep]
+    offsets = offsets[keep]
     print("hpi & pmh section check")
     print_statistic(note_df)
     print()
 
     # Split the section of free-text report
     print("Split the note section...")
+    # The note texts are materialized as Python strings once and sliced by every section below
+    texts = note_df["text"].tolist()
     token_list = ["Major Surgical or Invasive Procedure:", "History of Present Illness:"]
     for idx in range(len(token_list) - 1):
         print(token_list[idx][:-1])
-        note_df["start_idx"] = note_df.text.str.lower().str.find(token_list[idx].lower())
-        note_df["start_idx"] = note_df["start_idx"] + len(token_list[idx])
-        note_df["end_idx"] = note_df.text.str.lower().str.find(token_list[idx + 1].lower())
-        note_df[token_list[idx][:-1]] = note_df.apply(split_section, axis=1)
-        note_df[token_list[idx][:-1]] = note_df[token_list[idx][:-1]].str.replace("\n", " ").str.strip()
-
-    note_df = split_history_section(note_df, start_key="Allergies:", end_key1="Attending:", endkey2="Chief Complaint:")
-    note_df = split_history_section(note_df, start_key="Complaint:", end_key1="Major Surgical or Invasive Procedure:", endkey2="History of Present Illness:")
-    note_df = split_history_section(note_df, start_key="History of Present Illness:", end_key1="Past Medical History:", endkey2="PMH:")
-    note_df = split_history_section(note_df, start_key="Past Medical History:", end_key1="Social History:", endkey2="Family History:")
-    note_df = split_history_section(note_df, start_key="Social History:", end_key1="Family History:", endkey2="Physical Exam:")
-    note_df = split_history_section(note_df, start_key="Family History:", end_key1="Physical Exam:", endkey2="Discharge exam:")
-    note_df["pmi_word_cnt"] = note_df["Past Medical History"].apply(word_cnt)
-    note_df["hpi_word_cnt"] = note_df["History of Present Illness"].apply(word_cnt)
+        start_idx = offsets[token_list[idx]] + len(token_list[idx])
+        end_idx = offsets[token_list[idx + 1]]
+        note_df[token_list[idx][:-1]] = slice_sections(texts, start_idx.tolist(), end_idx.tolist())
+
+    note_df = split_history_section(note_df, texts, offsets, start_key="Allergies:", end_key1="Attending:", endkey2="Chief Complaint:")
+    note_df = split_history_section(note_df, texts, offsets, start_key="Complaint:", end_key1="Major Surgical or Invasive Procedure:", endkey2="History of Present Illness:")
+    note_df = split_history_section(note_df, texts, offsets, start_key="History of Present Illness:", end_key1="Past Medical History:", endkey2="PMH:")
+    note_df = split_history_section(note_df, texts, offsets, start_key="Past Medical History:", end_key1="Social History:", endkey2="Family History:")
+    note_df = split_history_section(note_df, texts, offsets, start_key="Social History:", end_key1="Family History:", endkey2="Physical Exam:")
+    note_df = split_history_section(note_df, texts, offsets, start_key="Family History:", end_key1="Physical Exam:", endkey2="Discharge exam:")
+    # Missing sections give NaN word counts
+    note_df["pmi_word_cnt"] = note_df["Past Medical History"].str.split().str.len()
+    note_df["hpi_word_cnt"] = note_df["History of Present Illness"].str.split().str.len()
     note_df["total_word_cnt"] = note_df["pmi_word_cnt"] + note_df["hpi_word_cnt"]
 
-    print_statistic(note_df)
-    print(note_df.hpi_word_cnt.describe())
-    print(note_df.pmi_word_cnt.describe())
-    print(note_df.total_word_cnt.describe())
-    print()
-    
+    print_filter_statistic(note_df)
+
+    # Build every filter as a mask over the same frame and copy the surviving rows once at the end;
+    # the statistics after each step are printed from the cumulative mask
+    keep = ~note_df["Complaint"].isna() & ~note_df["History of Present Illness"].isna() & ~note_df["Past Medical History"].isna()
     print("Remove nan section")
-    note_df = note_df[~note_df["Complaint"].isna() & ~note_df["History of Present Illness"].isna() & ~note_df["Past Medical History"].isna()]
-    print_statistic(note_df)
-    print(note_df.hpi_word_cnt.describe())
-    print(note_df.pmi_word_cnt.describe())
-    print(note_df.total_word_cnt.describe())
-    print()
+    print_filter_statistic(note_df, keep)
 
+    keep &= (note_df.hpi_word_cnt > 10) & (note_df.hpi_word_cnt < 350) & (note_df.pmi_word_cnt < 80)
     print("Remove outliers")
-    note_df = note_df[(note_df.hpi_word_cnt > 10) & (note_df.hpi_word_cnt < 350) & (note_df.pmi_word_cnt < 80)]
-    print_statistic(note_df)
-    print(note_df.hpi_word_cnt.describe())
-    print(note_df.pmi_word_cnt.describe())
-    print(note_df.total_word_cnt.describe())
-    print()
+    print_filter_statistic(note_df, keep)
 
-    # Filtered coma cases
-    note_df = note_df[(~note_df.text.str.lower().str.contains("stupor|coma"))]
+    # Filtered coma cases, reusing the lowercased text; the short sections below are matched case-insensitively
+    # instead of being lowercased into new columns
+    keep &= ~text_lc.str.contains("stupor|coma", na=False)
     print("Remove coma cases")
-    print_statistic(note_df)
-    print(note_df.hpi_word_cnt.describe())
-    print(note_df.pmi_word_cnt.describe())
-    print(note_df.total_word_cnt.describe())
-    print()
+    print_filter_statistic(note_df, keep)
 
     # Filtered dysarthria / memory issue patients
-    note_df = note_df[(~note_df["Complaint"].str.lower().str.contains("ams|altered mental status|confusion"))]
+    keep &= ~note_df["Complaint"].str.contains("ams|altered mental status|confusion", case=False, na=False)
     print("Remove confused cases")
-    print_statistic(note_df)
-    print(note_df.hpi_word_cnt.describe())
-    print(note_df.pmi_word_cnt.describe())
-    print(note_df.total_word_cnt.describe())
-    print()
+    print_filter_statistic(note_df, keep)
 
-    note_df = note_df[(~note_df["History of Present Illness"].str.lower().str.contains("dysarthria|aphasia|slurred speech"))]
+    keep &= ~note_df["History of Present Illness"].str.contains("dysarthria|aphasia|slurred speech", case=False, na=False)
     print("Remove speech problem cases")
-    print_statistic(note_df)
-    print(note_df.hpi_word_cnt.describe())
-    print(note_df.pmi_word_cnt.describe())
-    print(note_df.total_word_cnt.describe())
-    print()
+    print_filter_statistic(note_df, keep)
+
+    note_df = note_df.loc[keep]
 
     note_df = note_df[
         [
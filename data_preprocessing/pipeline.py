@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import key_extraction
+import data_filtering
+import key_modification
+from utils import file_to_string, save_to_json
+from llm_utils import ResponseCache, make_client, add_llm_args, setup_logging, check_template_fields, ResultCheckpoint, read_sample_df, template_fields
+
+
+def passes_filter(answer):
+    """
+    Return True if the filtering answer rates the sample as plausible enough to keep.
+    """
+    return isinstance(answer, dict) and answer.get("likelihood_rating", 0) > 2
+
+
+def filter_and_modify(args, client, model, df, raw_results, filter_checkpoint_path, mod_checkpoint_path, cache=None):
+    """
+    Run the filtering and modification stages as one pipeline.
+    A modification request is issued as soon as the filtering answer of the same sample
+    arrives and passes the filter, instead of waiting for the whole filtering batch.
+    Each stage has its own thread pool so their concurrency is capped independently.
+    Finished answers of both stages are appended to JSONL checkpoints, and samples already
+    in a checkpoint are not sent again, so an interrupted run resumes where it stopped.
+    """
+    filter_system_prompt = file_to_string(os.path.join(args.filtering_prompt_dir, "initial_system.txt"))
+    filter_user_prompt_template = file_to_string(os.path.join(args.filtering_prompt_dir, "initial_user.txt"))
+    mod_system_prompt = file_to_string(os.path.join(args.modification_prompt_dir, "initial_system.txt"))
+    mod_user_prompt_template = file_to_string(os.path.join(args.modification_prompt_dir, "initial_user.txt"))
+
+    filter_merged = data_filtering.build_merged(df, raw_results)
+    mod_merged = key_modification.build_merged(df, raw_results)
+    mod_rows = {row["hadm_id"]: row for row in mod_merged.to_dict(orient="records")}
+    check_template_fields(filter_user_prompt_template, filter_merged.columns)
+    check_template_fields(mod_user_prompt_template, mod_merged.columns)
+
+    filter_process = partial(
+        data_filtering.process_row, client=client, model=model, system_prompt=filter_system_prompt, user_prompt_template=filter_user_prompt_template, args=args, cache=cache
+    )
+    mod_process = partial(
+        key_modification.process_row, client=client, model=model, system_prompt=mod_system_prompt, user_prompt_template=mod_user_prompt_template, args=args, cache=cache
+    )
+
+    with ResultCheckpoint(filter_checkpoint_path) as filter_checkpoint, ResultCheckpoint(mod_checkpoint_path) as mod_checkpoint, \
+            ThreadPoolExecutor(max_workers=args.filtering_concurrency) as filter_executor, ThreadPoolExecutor(max_workers=args.modification_concurrency) as mod_executor:
+        mod_futures = []
+
+        def submit_modification(hadm_id, answer):
+            if passes_filter(answer) and hadm_id in mod_rows and hadm_id not in mod_checkpoint.done:
+                mod_futures.append(mod_executor.submit(mod_process, mod_rows[hadm_id]))
+
+        # Samples filtered before an interruption may still be waiting for their modification
+        for hadm_id, answer in list(filter_checkpoint.done.items()):
+            submit_modification(hadm_id, answer)
+
+        filter_futures = [
+            filter_executor.submit(filter_process, row) for row in filter_merged.to_dict(orient="records") if row["hadm_id"] not in filter_checkpoint.done
+        ]
+        for future in as_completed(filter_futures):
+            hadm_id, answer = future.result()
+            filter_checkpoint.add(hadm_id, answer)
+            submit_modification(hadm_id, answer)
+
+        for future in as_completed(mod_futures):
+            hadm_id, answer = future.result()
+            mod_checkpoint.add(hadm_id, answer)
+
+    filtering_results = dict(sorted(filter_checkpoint.done.items()))
+    final_results = [key_modification.build_final_output(mod_rows[hadm_id], answer) for hadm_id, answer in mod_checkpoint.done.items() if hadm_id in mod_rows]
+    final_results = sorted(final_results, key=lambda x: x["hadm_id"])
+    return filtering_results, final_results
+
+
+def main(args):
+    """
+    Run key extraction, filtering and modification in one process. The dataset is read once,
+    the client and model are set up once, and each stage takes the previous stage's results in memory.
+    """
+    model = args.model
+    logging.info(f"Using LLM: {model}")
+
+    extraction_system_prompt = file_to_string(os.path.join(args.extraction_prompt_dir, "initial_system.txt"))
+    extraction_user_prompt_template = file_to_string(os.path.join(args.extraction_prompt_dir, "initial_user.txt"))
+
+    # Load dataset with the columns used by any stage
+    columns = {"hadm_id", "mapped_icd_title", *template_fields(extraction_user_prompt_template), *data_filtering.USED_COLUMNS, *key_modification.USED_COLUMNS}
+    df = read_sample_df(args.data_dir, sorted(columns))
+    print(df.shape)
+
+    print(f"{args.model_api_type} api call")
+    client, model = make_client(args)
+    cache = None if args.no_cache else ResponseCache(args.cache_dir)
+
+    results_path = os.path.join(args.key_dir, f"{args.model}_results.json")
+    if args.skip_extraction:
+        with open(results_path, "r") as f:
+            raw_results = json.load(f)
+    else:
+        extraction_checkpoint_path = os.path.join(args.key_dir, f"{args.model}_results.jsonl")
+        if args.batch:
+            raw_results = key_extraction.batch_extraction_stage(args, df, extraction_system_prompt, extraction_user_prompt_template, extraction_checkpoint_path, cache)
+        else:
+            raw_results = key_extraction.extraction_stage(
+                args, client, model, df, extraction_system_prompt, extraction_user_prompt_template, args.extraction_concurrency, extraction_checkpoint_path, cache
+            )
+        save_to_json(raw_results, results_path)
+        os.remove(extraction_checkpoint_path)
+
+    filter_checkpoint_path = os.path.join(args.key_dir, f"{args.model}_filtering_results.jsonl")
+    mod_checkpoint_path = os.path.join(args.key_dir, f"{args.model}_mod_results.jsonl")
+    filtering_results, final_results = filter_and_modify(args, client, model, df, raw_results, filter_checkpoint_path, mod_checkpoint_path, cache)
+    print(f"Kept {len(final_results)} / {len(filtering_results)} samples after filtering")
+
+    save_to_json(filtering_results, os.path.join(args.key_dir, f"{args.model}_filtering_results.json"))
+    save_to_json(final_results, os.path.join(args.key_dir, f"{args.model}_mod_results.json"))
+    os.remove(filter_checkpoint_path)
+    os.remove(mod_checkpoint_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="gemini-2.5-flash",
+        choices=[
+            "gpt-4o",
+            "gemini-2.5-flash",
+        ],
+    )
+    parser.add_argument("--model_api_type", type=str, default="genai", choices=["gpt_azure", "genai", "vllm_server"])
+    parser.add_argument("--temperature", type=float, default=0.0, help="model temperature")
+    parser.add_argument("--random_seed", type=int, default=42)
+    parser.add_argument("--thinking_budget", type=int, default=1024)
+    parser.add_argument("--extraction_concurrency", type=int, default=8, help="number of concurrent key extraction requests")
+    parser.add_argument("--filtering_concurrency", type=int, default=8, help="number of concurrent filtering requests")
+    parser.add_argument("--modification_concurrency", type=int, default=8, help="number of concurrent modification requests")
+    add_llm_args(parser, concurrency=False)
+
+    parser.add_argument("--data_dir", type=str, default="./data", help="save dir")
+    parser.add_argument("--key_dir", type=str, default="./results/key_extraction", help="key_dir")
+    parser.add_argument("--extraction_prompt_dir", type=str, default="./prompts/key_extraction", help="key extraction prompt directory")
+    parser.add_argument("--filtering_prompt_dir", type=str, default="./prompts/data_filtering", help="filtering prompt directory")
+    parser.add_argument("--modification_prompt_dir", type=str, default="./prompts/key_modification", help="modification prompt directory")
+    parser.add_argument("--skip_extraction", action="store_true", help="reuse {model}_results.json in key_dir instead of running key extraction")
+
+    parser.add_argument("--batch", action="store_true", help="send the key extraction requests as one OpenAI Batch API job (gpt_azure only)")
+
+    args = parser.parse_args()
+    if args.batch and args.model_api_type != "gpt_azure":
+        parser.error("--batch is only supported with --model_api_type gpt_azure")
+
+    os.makedirs(args.key_dir, exist_ok=True)
+    setup_logging(os.path.join(args.key_dir, "pipeline_log.log"), logging.DEBUG if args.verbose else logging.INFO)
+
+    main(args)
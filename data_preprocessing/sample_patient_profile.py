@@ -1,10 +1,16 @@
 import os
+import re
+import csv
 import json
+import hashlib
 import pickle
 import argparse
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 
-from icdmappings import Mapper
 
 # Mapping for diagnosis codes to standardized keys
 DIAGNOSIS_MAPPING_KEYS = {
@@ -77,6 +83,118 @@ DIAGNOSIS_MAPPING_KEYS = {
 }
 
 
+# Chief complaints excluded from every sample (transfers and abnormal lab/imaging visits)
+# and, on top of those, from the diagnosis samples (speech and mental status problems); matched case-insensitively
+EXCLUDED_COMPLAINT_RE = re.compile("transfer|abnormal", re.IGNORECASE)
+EXCLUDED_SAMPLE_COMPLAINT_RE = re.compile("slurred speech|dysarthria|aphasia|ams|altered mental status|confusion", re.IGNORECASE)
+
+# Types of the MIMIC columns read below, so the pyarrow parser does not have to infer them;
+# the time columns are parsed to timestamps at read time. MIMIC ids fit in int32, which halves
+# the size of the merge keys (hadm_id still comes back as float64 where it has missing values)
+COLUMN_TYPES = {
+    "subject_id": pa.int32(),
+    "hadm_id": pa.int32(),
+    "stay_id": pa.int32(),
+    "seq_num": pa.int64(),
+    "icd_version": pa.int64(),
+    "anchor_age": pa.int64(),
+    "anchor_year": pa.int64(),
+    "admittime": pa.timestamp("s"),
+    "intime": pa.timestamp("s"),
+    "outtime": pa.timestamp("s"),
+    "icd_code": pa.string(),
+    "pain": pa.string(),
+}
+
+# Columns that identify a row of the merged ED stays: the stay-level columns are functions of stay_id
+# and the diagnosis columns tell the diagnosis rows of a stay apart, so duplicated rows are found on these alone
+ED_ROW_KEY = ["stay_id", "seq_num", "icd_code", "icd_version", "icd_title"]
+
+# Same missing-value markers as pd.read_csv
+NULL_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+
+def read_csv(path, usecols=None, newlines_in_values=False, cache_dir=None):
+    """
+    Read the usecols columns of a csv with the multithreaded pyarrow parser and return them as a pandas DataFrame.
+    As with pd.read_csv, the columns keep their order in the file.
+    If cache_dir is given, the parsed table is also stored there as Parquet, keyed on the csv's path, mtime and size
+    and the selected columns, so later runs read the Parquet copy instead of parsing the csv again.
+    """
+    if usecols is not None:
+        with open(path, newline="") as f:
+            header = next(csv.reader(f))
+        usecols = [col for col in header if col in usecols]
+
+    cache_path = None
+    if cache_dir is not None:
+        key = [os.path.abspath(path), os.path.getmtime(path), os.path.getsize(path), usecols, str(COLUMN_TYPES), NULL_VALUES]
+        cache_path = os.path.join(cache_dir, f"{hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()[:16]}.parquet")
+        if os.path.exists(cache_path):
+            return pq.read_table(cache_path).to_pandas()
+
+    table = pa_csv.read_csv(
+        path,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=newlines_in_values),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=usecols, column_types=COLUMN_TYPES, null_values=NULL_VALUES, strings_can_be_null=True
+        ),
+    )
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so an interrupted run never leaves a truncated cache entry
+        pq.write_table(table, f"{cache_path}.tmp", compression="snappy")
+        os.replace(f"{cache_path}.tmp", cache_path)
+    return table.to_pandas()
+
+
+def read_stay_medications(path):
+    """
+    Return the distinct medication names of every ED stay in medrecon.csv, in order of first appearance,
+    as a DataFrame with stay_id and name (a list) columns.
+    The csv is streamed in record batches and only the distinct (stay_id, name) pairs of each batch are kept,
+    so the full table is never held in memory.
+    """
+    reader = pa_csv.open_csv(
+        path,
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=["stay_id", "name"], column_types=COLUMN_TYPES, null_values=NULL_VALUES, strings_can_be_null=True
+        ),
+    )
+    pairs = pd.concat([batch.to_pandas().drop_duplicates() for batch in reader], ignore_index=True).drop_duplicates()
+    return pairs.groupby("stay_id").name.agg(list).reset_index()
+
+
+def print_id_counts(df, cols=("subject_id", "hadm_id", "stay_id"), verbose=True):
+    """
+    Print the number of distinct values of each id column of df.
+    Every count hashes a whole column, so they are only printed if verbose (--debug).
+    """
+    if not verbose:
+        return
+    for col in cols:
+        print(f"\t{col}: {df[col].nunique()}")
+
+
+def print_stay_statistic(title, df, keep, verbose=True):
+    """
+    Print the shape and the id counts of the rows of df selected by the boolean mask keep.
+    """
+    print(f"{title}: {(int(keep.sum()), df.shape[1])}")
+    if verbose:
+        print_id_counts(df.loc[keep, ["subject_id", "hadm_id", "stay_id"]])
+
+
+def single_value_keys(df, key, col):
+    """
+    Return the values of key that have exactly one distinct non-null value of col in df.
+    Same as the keys with groupby(key)[col].nunique() == 1, found with one hash pass over the distinct pairs.
+    """
+    pairs = df[[key, col]].dropna(subset=[col]).drop_duplicates()
+    return pairs.loc[~pairs[key].duplicated(keep=False), key]
+
+
 def load_pickle(data_path):
     """
     Load a pickle file from the given data path.
@@ -106,163 +224,154 @@ def main(args):
       diagnosis mapping, and additional clinical data.
     - Applies filtering criteria and sampling, and finally saves the sample DataFrame to a CSV file.
     """
+    # Parsed csv files are cached as Parquet, so reruns with another sample size or seed skip the csv parsing
+    cache_dir = None if args.no_cache else (args.cache_dir or os.path.join(args.preprocess_dir, "csv_cache"))
+
     # Load admissions and patients data from hospital files
     print("Loading admissions and patients data...")
-    admissions = pd.read_csv(
+    admissions = read_csv(
         os.path.join(args.mimic_dir, "hosp/admissions.csv"),
         usecols=["subject_id", "hadm_id", "admittime", "insurance", "language", "marital_status"],
+        cache_dir=cache_dir,
     )
     print(f"Admissions data shape:")
-    print(f"\tsubject_id: {admissions.subject_id.nunique()}")
-    print(f"\thadm_id: {admissions.hadm_id.nunique()}")
+    print_id_counts(admissions, ["subject_id", "hadm_id"], verbose=args.debug)
 
-    patients = pd.read_csv(os.path.join(args.mimic_dir, "hosp/patients.csv"), usecols=["subject_id", "anchor_age", "anchor_year"])
+    patients = read_csv(os.path.join(args.mimic_dir, "hosp/patients.csv"), usecols=["subject_id", "anchor_age", "anchor_year"], cache_dir=cache_dir)
     print(f"Patients data shape:")
-    print(f"\tsubject_id: {patients.subject_id.nunique()}")
+    print_id_counts(patients, ["subject_id"], verbose=args.debug)
 
-    admissions = admissions.merge(patients, on="subject_id")
-    admissions["age"] = pd.to_datetime(admissions["admittime"]).dt.year - admissions["anchor_year"] + admissions["anchor_age"]
+    admissions = admissions.merge(patients, on="subject_id", how="inner", validate="many_to_one")
+    admissions["age"] = admissions["admittime"].dt.year - admissions["anchor_year"] + admissions["anchor_age"]
     print(f"Admissions + Patients data shape: {admissions.shape}")
-    print(f"\tsubject_id: {admissions.subject_id.nunique()}")
-    print(f"\thadm_id: {admissions.hadm_id.nunique()}")
+    print_id_counts(admissions, ["subject_id", "hadm_id"], verbose=args.debug)
 
     # Remove outlier
     print("Remove NaN & Outliers...")
     admissions = admissions[(~admissions.marital_status.isna()) & (~admissions.insurance.isna())]
     print(f"Remove NaN & Outliers shape: {admissions.shape}")
-    print(f"\tsubject_id: {admissions.subject_id.nunique()}")
-    print(f"\thadm_id: {admissions.hadm_id.nunique()}")
+    print_id_counts(admissions, ["subject_id", "hadm_id"], verbose=args.debug)
 
     # Load emergency department (ED) related data
     print("Loading emergency department (ED) related data...")
-    edstays = pd.read_csv(
-        os.path.join(args.ed_dir, "edstays.csv"), usecols=["subject_id", "hadm_id", "stay_id", "intime", "outtime", "gender", "race", "arrival_transport", "disposition"]
+    edstays = read_csv(
+        os.path.join(args.ed_dir, "edstays.csv"),
+        usecols=["subject_id", "hadm_id", "stay_id", "intime", "outtime", "gender", "race", "arrival_transport", "disposition"],
+        cache_dir=cache_dir,
     )
-    triage = pd.read_csv(os.path.join(args.ed_dir, "triage.csv"), usecols=["stay_id", "chiefcomplaint", "pain"])
-    medrecon = pd.read_csv(os.path.join(args.ed_dir, "medrecon.csv"))
-    ed_diagnosis = pd.read_csv(os.path.join(args.ed_dir, "diagnosis.csv"), usecols=["subject_id", "stay_id", "seq_num", "icd_code", "icd_version", "icd_title"])
+    triage = read_csv(os.path.join(args.ed_dir, "triage.csv"), usecols=["stay_id", "chiefcomplaint", "pain"], cache_dir=cache_dir)
+    ed_diagnosis = read_csv(os.path.join(args.ed_dir, "diagnosis.csv"), usecols=["subject_id", "stay_id", "seq_num", "icd_code", "icd_version", "icd_title"], cache_dir=cache_dir)
     print(f"ED stay data shape: {edstays.shape}")
-    print(f"\tsubject_id: {edstays.subject_id.nunique()}")
-    print(f"\thadm_id: {edstays.hadm_id.nunique()}")
-    print(f"\tstay_id: {edstays.stay_id.nunique()}")
+    print_id_counts(edstays, verbose=args.debug)
 
     print(f"ED diagnosis data shape: {ed_diagnosis.shape}")
-    print(f"\tsubject_id: {ed_diagnosis.subject_id.nunique()}")
-    print(f"\tstay_id: {ed_diagnosis.stay_id.nunique()}")
+    print_id_counts(ed_diagnosis, ["subject_id", "stay_id"], verbose=args.debug)
+
+    # Only stays of the admission cohort can survive the final merge, so drop the others before the ED merges
+    cohort_subjects = pd.Index(admissions["subject_id"].unique())
+    edstays = edstays[edstays["subject_id"].isin(cohort_subjects)]
+    ed_diagnosis = ed_diagnosis[ed_diagnosis["subject_id"].isin(cohort_subjects)]
+    print(f"Restrict ED data to the admission cohort: {edstays.shape}, {ed_diagnosis.shape}")
+    print_id_counts(edstays, ["subject_id", "stay_id"], verbose=args.debug)
+
     ed_diagnosis["icd_title"] = ed_diagnosis["icd_title"].str.lower()
-    diag_cnt = ed_diagnosis.groupby("stay_id").icd_title.nunique()
-    ed_diagnosis = ed_diagnosis[ed_diagnosis.stay_id.isin(diag_cnt[diag_cnt == 1].index)].drop_duplicates()
+    ed_diagnosis = ed_diagnosis[ed_diagnosis.stay_id.isin(single_value_keys(ed_diagnosis, "stay_id", "icd_title"))].drop_duplicates()
     print(f"Remove diagnosis > 1: {ed_diagnosis.shape}")
-    print(f"\tsubject_id: {ed_diagnosis.subject_id.nunique()}")
-    print(f"\tstay_id: {ed_diagnosis.stay_id.nunique()}")
+    print_id_counts(ed_diagnosis, ["subject_id", "stay_id"], verbose=args.debug)
 
     # Merge ED stays with triage & diagnosis information
     print("Merging ED stays with triage & diagnosis data...")
-    edstays = edstays.merge(triage, on=["stay_id"], how="inner")
-    edstays = edstays.merge(ed_diagnosis, on=["subject_id", "stay_id"], how="inner")
+    # validate= states which side is unique on the key, so a change in the source tables fails here instead of silently duplicating rows
+    edstays = edstays.merge(triage, on=["stay_id"], how="inner", validate="one_to_one")
+    edstays = edstays.merge(ed_diagnosis, on=["subject_id", "stay_id"], how="inner", validate="one_to_many")
     print(f"ED stay data shape: {edstays.shape}")
-    print(f"\tsubject_id: {edstays.subject_id.nunique()}")
-    print(f"\thadm_id: {edstays.hadm_id.nunique()}")
-    print(f"\tstay_id: {edstays.stay_id.nunique()}")
+    print_id_counts(edstays, verbose=args.debug)
 
     print("Merging ED stays with medication reconciliation data...")
-    medrecon_list = pd.DataFrame(medrecon.groupby("stay_id").name.unique()).reset_index()
-    edstays = edstays.merge(medrecon_list[["stay_id", "name"]].rename(columns={"name": "medication"}), on=["stay_id"], how="left")
+    medrecon_list = read_stay_medications(os.path.join(args.ed_dir, "medrecon.csv"))
+    edstays = edstays.merge(medrecon_list[["stay_id", "name"]].rename(columns={"name": "medication"}), on=["stay_id"], how="left", validate="many_to_one")
     edstays["medication"] = edstays["medication"].str.join(", ")
-    edstays["num_medication"] = edstays.medication.str.split(", ").str.len()
+    # Same count as splitting on ", ", without building the lists
+    edstays["num_medication"] = edstays["medication"].str.count(", ") + 1
 
     # Remove outlier
-    edstays["intime"] = pd.to_datetime(edstays["intime"])
-    edstays["outtime"] = pd.to_datetime(edstays["outtime"])
+    # The filters below build one cumulative mask and copy the surviving rows once;
+    # the statistics after each step are printed from the mask
     edstays["ed_stay_duration"] = edstays["outtime"] - edstays["intime"]
-    edstays = edstays[edstays.ed_stay_duration.dt.total_seconds() > 0].drop_duplicates()
-    print(f"Remove outlier (ED stay time < 0): {edstays.shape}")
-    print(f"\tsubject_id: {edstays.subject_id.nunique()}")
-    print(f"\thadm_id: {edstays.hadm_id.nunique()}")
-    print(f"\tstay_id: {edstays.stay_id.nunique()}")
+    # Compare the timestamps directly rather than converting every duration to float seconds (NaT compares False either way).
+    # Duplicated rows are dropped with the same mask, which gives the same rows as filtering first
+    keep = (edstays["outtime"] > edstays["intime"]) & ~edstays.duplicated(subset=ED_ROW_KEY)
+    print_stay_statistic("Remove outlier (ED stay time < 0)", edstays, keep, verbose=args.debug)
 
     # Remove outlier
     print("Remove nan...")
-    edstays = edstays[(edstays.race != "UNKNOWN") & (~edstays.chiefcomplaint.isna()) & (edstays.arrival_transport != "UNKNOWN")]
-    print(f"ED stay data shape: {edstays.shape}")
-    print(f"\tsubject_id: {edstays.subject_id.nunique()}")
-    print(f"\thadm_id: {edstays.hadm_id.nunique()}")
-    print(f"\tstay_id: {edstays.stay_id.nunique()}")
+    keep &= (edstays.race != "UNKNOWN") & (~edstays.chiefcomplaint.isna()) & (edstays.arrival_transport != "UNKNOWN")
+    print_stay_statistic("ED stay data shape", edstays, keep, verbose=args.debug)
 
     # Convert the 'pain' column to numeric values, coercing errors to NaN
     print("Converting 'pain' column to numeric values...")
     edstays["pain"] = pd.to_numeric(edstays["pain"], errors="coerce")
-    edstays = edstays[~((edstays.pain > 10) | (edstays.pain < 0))]  # remove 13 (outliers)
-    edstays = edstays.dropna(subset=["pain"])
-    edstays = edstays[edstays.num_medication < 16]
-    print(f"Remove pain & medication outlier: {edstays.shape}")
-    print(f"\tsubject_id: {edstays.subject_id.nunique()}")
-    print(f"\thadm_id: {edstays.hadm_id.nunique()}")
-    print(f"\tstay_id: {edstays.stay_id.nunique()}")
+    keep &= edstays.pain.between(0, 10) & (edstays.num_medication < 16)  # remove 13 (outliers) and missing pain
+    print_stay_statistic("Remove pain & medication outlier", edstays, keep, verbose=args.debug)
+    edstays = edstays.loc[keep]
 
     # Merge admissions with ED stays data and drop unnecessary columns
     print("Merging admissions data with ED stays...")
-    admissions = admissions.merge(edstays, on=["subject_id", "hadm_id"], how="inner").drop(columns=["admittime", "anchor_age", "anchor_year"])
+    # The columns only needed for the age are dropped before the merge, so the join does not copy them
+    admissions = admissions.drop(columns=["admittime", "anchor_age", "anchor_year"]).merge(edstays, on=["subject_id", "hadm_id"], how="inner", validate="one_to_many")
     print(f"Admissions data after merge shape: {admissions.shape}")
-    print(f"\tsubject_id: {admissions.subject_id.nunique()}")
-    print(f"\thadm_id: {admissions.hadm_id.nunique()}")
+    print_id_counts(admissions, ["subject_id", "hadm_id"], verbose=args.debug)
 
-    _cnt = admissions.groupby("hadm_id").stay_id.nunique()
-    admissions = admissions[admissions.hadm_id.isin(_cnt[_cnt == 1].index)].drop_duplicates()
+    # The admission columns are functions of hadm_id, so the ED row key also identifies the merged rows
+    admissions = admissions[admissions.hadm_id.isin(single_value_keys(admissions, "hadm_id", "stay_id"))].drop_duplicates(subset=["hadm_id", *ED_ROW_KEY])
     print(f"""Remove hadm with more than 1 ED stay: -> {admissions.shape}""")
-    print(f"\tsubject_id: {admissions.subject_id.nunique()}")
-    print(f"\thadm_id: {admissions.hadm_id.nunique()}")
-    print(f"\tstay_id: {admissions.stay_id.nunique()}")
+    print_id_counts(admissions, verbose=args.debug)
 
     print("Loading note sections and meta information...")
     # Load note sections and meta information DataFrames
-    note_df = pd.read_csv(os.path.join(args.preprocess_dir, "note_section.csv"))
+    note_df = read_csv(os.path.join(args.preprocess_dir, "note_section.csv"), newlines_in_values=True, cache_dir=cache_dir)
     print(f"Loaded note_df with shape: {note_df.shape}")
-    print(f"\tsubject_id: {note_df.subject_id.nunique()}")
-    print(f"\thadm_id: {note_df.hadm_id.nunique()}")
+    print_id_counts(note_df, ["subject_id", "hadm_id"], verbose=args.debug)
 
     print("Merging note sections with existing DataFrame...")
     admissions = admissions.merge(note_df, on=["subject_id", "hadm_id"])
     print(f"Merging note information: {admissions.shape}")
-    print(f"\tsubject_id: {admissions.subject_id.nunique()}")
-    print(f"\thadm_id: {admissions.hadm_id.nunique()}")
-    print(f"\tstay_id: {admissions.stay_id.nunique()}")
+    print_id_counts(admissions, verbose=args.debug)
     # print(filtered_df.groupby("mapped_icd_title").stay_id.nunique())
 
-    admissions = admissions[(~admissions["chiefcomplaint"].str.lower().str.contains("transfer|abnormal"))].reset_index(drop=True)
+    admissions = admissions[~admissions["chiefcomplaint"].str.contains(EXCLUDED_COMPLAINT_RE)].reset_index(drop=True)
     admissions["hadm_id"] = admissions["hadm_id"].astype(int).astype(str)
-    output_path = os.path.join(args.save_dir, "filtered_all_df.csv")
-    admissions.to_csv(output_path, index=False)
+    # The full cohort is only an intermediate, so it is stored as snappy-compressed Parquet, which is written
+    # by pyarrow's C++ writer and keeps the column types; sample_df.csv stays csv for the LLM scripts
+    output_path = os.path.join(args.save_dir, "filtered_all_df.parquet")
+    admissions.to_parquet(output_path, engine="pyarrow", compression="snappy", index=False)
 
     # Create a mapping dictionary for diagnosis codes to their respective standard keys
     mapping_dict = {code: key for key, codes in DIAGNOSIS_MAPPING_KEYS.items() for code in codes}
-    merged_icd_titles = [code for codes in DIAGNOSIS_MAPPING_KEYS.values() for code in codes]
-    filtered_df = admissions[admissions.icd_title.isin(merged_icd_titles)]
-    filtered_df["mapped_icd_title"] = filtered_df["icd_title"].map(mapping_dict)
+    # One hash lookup per row both maps the title and marks the rows to keep (unmapped titles become NaN)
+    admissions["mapped_icd_title"] = admissions["icd_title"].map(mapping_dict)
+    filtered_df = admissions[admissions["mapped_icd_title"].notna()]
     print(f"Filtered meta_info for mapped ICD titles. Shape: {filtered_df.shape}")
-    print(f"\tsubject_id: {filtered_df.subject_id.nunique()}")
-    print(f"\thadm_id: {filtered_df.hadm_id.nunique()}")
-    print(f"\tstay_id: {filtered_df.stay_id.nunique()}")
+    print_id_counts(filtered_df, verbose=args.debug)
     print(filtered_df.groupby("mapped_icd_title").stay_id.nunique())
 
-    # Filter out records with chief complaints containing "transfer" (case-insensitive)
+    # filtered_df is already free of transfer / abnormal complaints, so only the speech and mental status terms are matched here
     # print("Applying filters on chief complaint and past medical history...")
     print("Remove slurred speech...")
-    filtered_df = filtered_df[(~filtered_df["chiefcomplaint"].str.lower().str.contains("slurred speech|transfer|abnormal|dysarthria|aphasia|ams|altered mental status|confusion"))].reset_index(drop=True)
+    filtered_df = filtered_df[~filtered_df["chiefcomplaint"].str.contains(EXCLUDED_SAMPLE_COMPLAINT_RE)].reset_index(drop=True)
     print(f"Remove slurred speech / transfer: {filtered_df.shape}")
-    print(f"\tsubject_id: {filtered_df.subject_id.nunique()}")
-    print(f"\thadm_id: {filtered_df.hadm_id.nunique()}")
-    print(f"\tstay_id: {filtered_df.stay_id.nunique()}")
+    print_id_counts(filtered_df, verbose=args.debug)
     print(filtered_df.groupby("mapped_icd_title").stay_id.nunique())
 
     # Sample n records per 'mapped_icd_title'
     print("Sampling records per mapped ICD title...")
-    filtered_df = (
-        filtered_df.groupby("mapped_icd_title", group_keys=False).apply(lambda x: x.sample(n=min(args.num_sample, len(x)), random_state=args.random_seed)).reset_index(drop=True)
-    )
+    # Draw the row positions of every title with numpy and gather them with a single iloc, instead of a DataFrame.sample per group
+    rng = np.random.default_rng(args.random_seed)
+    group_positions = filtered_df.groupby("mapped_icd_title").indices
+    sampled_positions = [rng.choice(positions, size=min(args.num_sample, len(positions)), replace=False) for positions in group_positions.values()]
+    filtered_df = filtered_df.iloc[np.concatenate(sampled_positions)].reset_index(drop=True)
     print(f"Final sampled data shape: {filtered_df.shape}")
-    print(f"\tsubject_id: {filtered_df.subject_id.nunique()}")
-    print(f"\thadm_id: {filtered_df.hadm_id.nunique()}")
+    print_id_counts(filtered_df, ["subject_id", "hadm_id"], verbose=args.debug)
     print(filtered_df.groupby("mapped_icd_title").subject_id.nunique())
 
 
@@ -282,7 +391,9 @@ if __name__ == "__main__":
     parser.add_argument("--save_dir", type=str, default="./profile_data")
     parser.add_argument("--num_sample", type=int, default=40)
     parser.add_argument("--random_seed", type=int, default=42)
-    parser.add_argument("--debug", action="store_true", help="debug or not")
+    parser.add_argument("--cache_dir", type=str, default=None, help="directory of the Parquet copies of the parsed csv files (default: <preprocess_dir>/csv_cache)")
+    parser.add_argument("--no_cache", action="store_true", help="always parse the csv files instead of reusing their Parquet copies")
+    parser.add_argument("--debug", action="store_true", help="also print the distinct id counts after every step")
 
     args = parser.parse_args()
     os.makedirs(args.save_dir, exist_ok=True)
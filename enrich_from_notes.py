@@ -3,20 +3,109 @@ Enrich patient records with information extracted from discharge notes
 """
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.compute as pc
 import json
 import re
+import multiprocessing
+from itertools import islice
 
 
-def extract_section(text, start_key, end_keys):
-    """Extract section between start_key and first occurrence of end_keys"""
-    text_lower = text.lower()
-    start_idx = text_lower.find(start_key.lower())
+# Patterns used for every note, compiled once at import
+QUIT_SMOKING_RE = re.compile(r'quit.{0,30}(\d+)\s*(year|yr)')
+PACK_YEARS_RE = re.compile(r'(\d+)\s*pack')
+LIVES_WITH_RE = re.compile(r'lives with ([\w\s,]+?)(?:\.|in |at |$)')
+OCCUPATION_PATTERNS = [
+    (re.compile(r'retired\s+(\w+)'), lambda m: f'Retired {m.group(1)}'),
+    (re.compile(r'works?\s+as\s+(?:a\s+)?(\w+(?:\s+\w+)?)'), lambda m: m.group(1).title()),
+    (re.compile(r'employed\s+as\s+(?:a\s+)?(\w+(?:\s+\w+)?)'), lambda m: m.group(1).title()),
+    (re.compile(r'\b(teacher|nurse|engineer|manager|construction worker|driver|student|homemaker|disabled|unemployed|retired)\b'),
+     lambda m: m.group(1).title())
+]
+# Look for denial patterns with more flexible matching
+DENIAL_PATTERNS = [
+    re.compile(r'denies[^.!?]{5,150}[.!?]'),  # More flexible
+    re.compile(r'denied[^.!?]{5,150}[.!?]'),
+    re.compile(r'no\s+\w+(?:\s+\w+){0,8}[,.]'),  # Match "no X" patterns
+    re.compile(r'negative for[^.!?]{5,100}[.!?]'),
+    re.compile(r'without\s+\w+(?:\s+\w+){0,8}[,.]'),
+    re.compile(r'absent[^.!?]{5,100}[.!?]'),
+    re.compile(r'reports no[^.!?]{5,100}[.!?]'),
+]
+# Numbered medication lines like "1. Acetaminophen 500 mg PO Q6H"
+MEDICATION_LINE_RE = re.compile(r'\d+\.\s+([A-Za-z][A-Za-z\s\-]+?)(?:\s+\d+|\s+PO|\s+IV|\s+\(|$)')
+PAIN_SCALE_RE = re.compile(r'(\d+)/10\s*pain|pain\s*(\d+)/10')
+PAIN_DESCRIPTOR_RE = re.compile(r'(sharp|dull|stabbing|burning|aching|throbbing|cramping)\s+pain')
+# Record fields left out of the null counts
+EXCLUDED_FIELDS = frozenset(['hadm_id', 'cefr_A1', 'cefr_A2', 'cefr_B1', 'cefr_B2', 'cefr_C1', 'cefr_C2', 'med_A', 'med_B', 'med_C'])
+# Section keys (based on note_preprocessing.py): start key and the keys that may end the section
+SECTION_MAP = {
+    'Allergies': ('Allergies:', ['Attending:', 'Chief Complaint:', 'Major Surgical']),
+    'Chief Complaint': ('Chief Complaint:', ['Major Surgical', 'History of Present Illness:']),
+    'History of Present Illness': ('History of Present Illness:', ['Past Medical History:', 'PMH:']),
+    'Past Medical History': ('Past Medical History:', ['Social History:', 'Family History:']),
+    'Social History': ('Social History:', ['Family History:', 'Physical Exam:']),
+    'Family History': ('Family History:', ['Physical Exam:', 'Pertinent Results:']),
+    'Physical Exam': ('Physical Exam:', ['Pertinent Results:', 'Brief Hospital Course:', 'Discharge Medications:']),
+    'Discharge Medications': ('Discharge Medications:', ['Discharge Disposition:', 'Discharge Diagnosis:', 'Discharge Condition:'])
+}
+# Common medical devices (lowercase keywords), built once at import
+DEVICE_KEYWORDS = {
+    'pacemaker': 'Pacemaker',
+    'icd': 'Implantable cardioverter-defibrillator (ICD)',
+    'aicd': 'Automatic implantable cardioverter-defibrillator',
+    'defibrillator': 'Defibrillator',
+    'coronary stent': 'Coronary stent',
+    'cardiac stent': 'Cardiac stent',
+    'stent': 'Stent',
+    'prosthetic valve': 'Prosthetic heart valve',
+    'artificial valve': 'Artificial heart valve',
+    'insulin pump': 'Insulin pump',
+    'g-tube': 'Gastrostomy tube (G-tube)',
+    'j-tube': 'Jejunostomy tube (J-tube)',
+    'peg tube': 'PEG tube',
+    'feeding tube': 'Feeding tube',
+    'tracheostomy': 'Tracheostomy',
+    'trach': 'Tracheostomy',
+    'colostomy': 'Colostomy',
+    'ileostomy': 'Ileostomy',
+    'ostomy': 'Ostomy',
+    'port-a-cath': 'Port-a-cath',
+    'mediport': 'Mediport',
+    'picc line': 'PICC line',
+    'central line': 'Central line',
+    'foley catheter': 'Foley catheter',
+    'foley': 'Foley catheter',
+    'home oxygen': 'Home oxygen',
+    'cpap': 'CPAP',
+    'bipap': 'BiPAP',
+}
+# All device keywords as whole words, longest first, so a keyword inside a longer one ("stent" in "coronary stent")
+# or inside another word ("trach" in "trachea") is not matched on its own; a plural "s" is allowed ("stents")
+DEVICE_RE = re.compile(r'\b(' + '|'.join(re.escape(k) for k in sorted(DEVICE_KEYWORDS, key=len, reverse=True)) + r')s?\b')
+
+
+def extract_section(text, start_key, end_keys, text_lower=None, offsets=None):
+    """Extract section between start_key and first occurrence of end_keys (text_lower: text.lower(), if already computed;
+    offsets: dict of the key offsets in text_lower, filled as keys are searched and shared by calls on the same text)"""
+    if text_lower is None:
+        text_lower = text.lower()
+    if offsets is None:
+        offsets = {}
+    
+    def find(key):
+        if key not in offsets:
+            offsets[key] = text_lower.find(key.lower())
+        return offsets[key]
+    
+    start_idx = find(start_key)
     
     if start_idx == -1:
         return None
     
     # Find first occurrence of any end key
-    end_positions = [text_lower.find(key.lower()) for key in end_keys]
+    end_positions = [find(key) for key in end_keys]
     valid_positions = [pos for pos in end_positions if pos > start_idx]
     
     if not valid_positions:
@@ -31,20 +120,11 @@ def extract_note_sections(note_text):
     """Extract structured sections from discharge note"""
     sections = {}
     
-    # Define section keys (based on note_preprocessing.py)
-    section_map = {
-        'Allergies': ('Allergies:', ['Attending:', 'Chief Complaint:', 'Major Surgical']),
-        'Chief Complaint': ('Chief Complaint:', ['Major Surgical', 'History of Present Illness:']),
-        'History of Present Illness': ('History of Present Illness:', ['Past Medical History:', 'PMH:']),
-        'Past Medical History': ('Past Medical History:', ['Social History:', 'Family History:']),
-        'Social History': ('Social History:', ['Family History:', 'Physical Exam:']),
-        'Family History': ('Family History:', ['Physical Exam:', 'Pertinent Results:']),
-        'Physical Exam': ('Physical Exam:', ['Pertinent Results:', 'Brief Hospital Course:', 'Discharge Medications:']),
-        'Discharge Medications': ('Discharge Medications:', ['Discharge Disposition:', 'Discharge Diagnosis:', 'Discharge Condition:'])
-    }
-    
-    for section_name, (start_key, end_keys) in section_map.items():
-        sections[section_name] = extract_section(note_text, start_key, end_keys)
+    # Lowercase the note once for all sections, and search each header once even if several sections end at it
+    note_text_lower = note_text.lower()
+    offsets = {}
+    for section_name, (start_key, end_keys) in SECTION_MAP.items():
+        sections[section_name] = extract_section(note_text, start_key, end_keys, note_text_lower, offsets)
     
     return sections
 
@@ -61,7 +141,7 @@ def extract_from_social_history(social_text):
     if 'never smok' in text_lower or 'non-smok' in text_lower or 'non smok' in text_lower or 'denies tobacco' in text_lower:
         fields['tobacco'] = 'Never smoker'
     elif 'quit' in text_lower and 'smok' in text_lower:
-        match = re.search(r'quit.{0,30}(\d+)\s*(year|yr)', text_lower)
+        match = QUIT_SMOKING_RE.search(text_lower)
         if match:
             fields['tobacco'] = f'Former smoker (quit {match.group(1)} years ago)'
         else:
@@ -70,7 +150,7 @@ def extract_from_social_history(social_text):
         fields['tobacco'] = 'Former smoker'
     elif 'smok' in text_lower:
         # Extract pack-year if available
-        match = re.search(r'(\d+)\s*pack', text_lower)
+        match = PACK_YEARS_RE.search(text_lower)
         if match:
             fields['tobacco'] = f'Current smoker ({match.group(1)} pack-years)'
         else:
@@ -97,23 +177,15 @@ def extract_from_social_history(social_text):
         fields['illicit_drug'] = 'Drug use history'
     
     # Occupation
-    occupation_patterns = [
-        (r'retired\s+(\w+)', lambda m: f'Retired {m.group(1)}'),
-        (r'works?\s+as\s+(?:a\s+)?(\w+(?:\s+\w+)?)', lambda m: m.group(1).title()),
-        (r'employed\s+as\s+(?:a\s+)?(\w+(?:\s+\w+)?)', lambda m: m.group(1).title()),
-        (r'\b(teacher|nurse|engineer|manager|construction worker|driver|student|homemaker|disabled|unemployed|retired)\b', 
-         lambda m: m.group(1).title())
-    ]
-    
-    for pattern, formatter in occupation_patterns:
-        match = re.search(pattern, text_lower)
+    for pattern, formatter in OCCUPATION_PATTERNS:
+        match = pattern.search(text_lower)
         if match:
             fields['occupation'] = formatter(match)
             break
     
     # Living situation
     if 'lives with' in text_lower:
-        match = re.search(r'lives with ([\w\s,]+?)(?:\.|in |at |$)', text_lower)
+        match = LIVES_WITH_RE.search(text_lower)
         if match:
             living_with = match.group(1).strip().rstrip(',')
             fields['living_situation'] = f'Lives with {living_with}'
@@ -135,8 +207,10 @@ def extract_from_other_sections(sections):
     if sections.get('Chief Complaint'):
         cc = sections['Chief Complaint'].strip()
         # Clean up common patterns
-        cc = re.sub(r'^\s*:\s*', '', cc)
-        cc = re.sub(r'\s+', ' ', cc)
+        # cc is already stripped, so string methods do what the regex substitutions did
+        if cc.startswith(':'):
+            cc = cc[1:].lstrip()
+        cc = ' '.join(cc.split())
         if len(cc) > 5 and len(cc) < 200:
             fields['chiefcomplaint'] = cc
     
@@ -170,33 +244,19 @@ def extract_from_other_sections(sections):
         negatives = []
         hpi_lower = hpi.lower()
         
-        # Look for denial patterns with more flexible matching
-        denial_patterns = [
-            r'denies[^.!?]{5,150}[.!?]',  # More flexible
-            r'denied[^.!?]{5,150}[.!?]',
-            r'no\s+\w+(?:\s+\w+){0,8}[,.]',  # Match "no X" patterns
-            r'negative for[^.!?]{5,100}[.!?]',
-            r'without\s+\w+(?:\s+\w+){0,8}[,.]',
-            r'absent[^.!?]{5,100}[.!?]',
-            r'reports no[^.!?]{5,100}[.!?]',
-        ]
-        
-        for pattern in denial_patterns:
-            matches = re.findall(pattern, hpi_lower)
-            for match in matches[:3]:  # Take up to 3 matches per pattern
-                clean = match.strip()
+        for pattern in DENIAL_PATTERNS:
+            # Take up to 3 matches per pattern; the scan stops once they are found instead of matching the whole HPI
+            for match in islice(pattern.finditer(hpi_lower), 3):
+                clean = match.group().strip()
                 if len(clean) > 10:  # Avoid very short matches
                     negatives.append(clean)
         
         if negatives:
             # Deduplicate and combine
-            unique_negatives = []
-            seen = set()
+            unique_negatives = {}
             for neg in negatives:
-                if neg[:30] not in seen:  # Check first 30 chars to avoid duplicates
-                    unique_negatives.append(neg)
-                    seen.add(neg[:30])
-            fields['present_illness_negative'] = ' '.join(unique_negatives[:3])[:300]
+                unique_negatives.setdefault(neg[:30], neg)  # Keep the first of each 30-char prefix to avoid duplicates
+            fields['present_illness_negative'] = ' '.join(list(unique_negatives.values())[:3])[:300]
         elif any(keyword in hpi_lower for keyword in ['denies', 'denied', 'no ', 'negative', 'without']):
             # If we found negative keywords but no matches, provide a generic statement
             fields['present_illness_negative'] = 'Patient denies relevant negative symptoms (see full HPI)'
@@ -210,7 +270,7 @@ def extract_from_other_sections(sections):
             for line in meds_text.split('\n')[:15]:  # Take first 15 medications
                 line = line.strip()
                 # Match numbered medication lines like "1. Acetaminophen 500 mg PO Q6H"
-                match = re.match(r'\d+\.\s+([A-Za-z][A-Za-z\s\-]+?)(?:\s+\d+|\s+PO|\s+IV|\s+\(|$)', line)
+                match = MEDICATION_LINE_RE.match(line)
                 if match:
                     med_name = match.group(1).strip()
                     if len(med_name) > 2:
@@ -224,43 +284,16 @@ def extract_from_other_sections(sections):
     if device_info:
         fields['medical_device'] = device_info
     
+    # Pain - search in Chief Complaint, HPI and Physical Exam
+    pain_info = extract_pain_info(sections)
+    if pain_info:
+        fields['pain'] = pain_info
+    
     return fields
 
 
 def extract_medical_devices(sections):
     """Extract medical device information from note sections"""
-    # Common medical devices
-    device_keywords = {
-        'pacemaker': 'Pacemaker',
-        'icd': 'Implantable cardioverter-defibrillator (ICD)',
-        'aicd': 'Automatic implantable cardioverter-defibrillator',
-        'defibrillator': 'Defibrillator',
-        'coronary stent': 'Coronary stent',
-        'cardiac stent': 'Cardiac stent',
-        'stent': 'Stent',
-        'prosthetic valve': 'Prosthetic heart valve',
-        'artificial valve': 'Artificial heart valve',
-        'insulin pump': 'Insulin pump',
-        'g-tube': 'Gastrostomy tube (G-tube)',
-        'j-tube': 'Jejunostomy tube (J-tube)',
-        'peg tube': 'PEG tube',
-        'feeding tube': 'Feeding tube',
-        'tracheostomy': 'Tracheostomy',
-        'trach': 'Tracheostomy',
-        'colostomy': 'Colostomy',
-        'ileostomy': 'Ileostomy',
-        'ostomy': 'Ostomy',
-        'port-a-cath': 'Port-a-cath',
-        'mediport': 'Mediport',
-        'picc line': 'PICC line',
-        'central line': 'Central line',
-        'foley catheter': 'Foley catheter',
-        'foley': 'Foley catheter',
-        'home oxygen': 'Home oxygen',
-        'cpap': 'CPAP',
-        'bipap': 'BiPAP',
-    }
-    
     # Search in Past Medical History first
     search_text = ''
     if sections.get('Past Medical History'):
@@ -274,23 +307,22 @@ def extract_medical_devices(sections):
         return "None"
     
     # Find all matching devices
+    # One scan finds the keywords; the devices are then listed in the order of DEVICE_KEYWORDS
+    found_keywords = set(DEVICE_RE.findall(search_text))
     found_devices = []
-    for keyword, device_name in device_keywords.items():
-        if keyword.lower() in search_text:
-            # Avoid duplicates (e.g., "stent" and "coronary stent")
-            if not any(d.lower() in device_name.lower() for d in found_devices):
-                found_devices.append(device_name)
+    for keyword, device_name in DEVICE_KEYWORDS.items():
+        # Avoid duplicates (e.g., "foley" and "foley catheter")
+        if keyword in found_keywords and device_name not in found_devices:
+            found_devices.append(device_name)
+            # Only the first 3 devices are reported
+            if len(found_devices) == 3:
+                break
     
     if found_devices:
         # Return up to 3 devices
         return ', '.join(found_devices[:3])
     
     return "None"
-    pain_info = extract_pain_info(sections)
-    if pain_info:
-        fields['pain'] = pain_info
-    
-    return fields
 
 
 def extract_pain_info(sections):
@@ -307,7 +339,7 @@ def extract_pain_info(sections):
     combined_text = ' '.join(search_sections).lower()
     
     # Pattern 1: Pain scale (e.g., "8/10 pain", "pain 7/10")
-    pain_scale_match = re.search(r'(\d+)/10\s*pain|pain\s*(\d+)/10', combined_text)
+    pain_scale_match = PAIN_SCALE_RE.search(combined_text)
     if pain_scale_match:
         score = pain_scale_match.group(1) or pain_scale_match.group(2)
         return f"{score}/10 pain scale"
@@ -325,7 +357,7 @@ def extract_pain_info(sections):
         return "Denies pain"
     
     # Pattern 4: Specific pain locations with descriptors
-    pain_descriptors = re.findall(r'(sharp|dull|stabbing|burning|aching|throbbing|cramping)\s+pain', combined_text)
+    pain_descriptors = PAIN_DESCRIPTOR_RE.findall(combined_text)
     if pain_descriptors:
         return f"{pain_descriptors[0].capitalize()} pain reported"
     
@@ -336,57 +368,80 @@ def load_discharge_notes(hadm_ids, note_path='../../mimic_4/note/discharge.csv.g
     """Load discharge notes for specified admissions"""
     print(f"Loading discharge notes from {note_path}...")
     
-    notes_df = pd.read_csv(note_path)
-    print(f"Loaded {len(notes_df)} total discharge notes")
-    
+    # Only the id and the text of the notes are used. They are parsed with pyarrow, called directly since
+    # pandas' pyarrow engine cannot parse the quoted multi-line note text, and streamed in record batches
+    # that are filtered for our admissions as they are read, so the full notes table is never held in memory
+    reader = pa_csv.open_csv(
+        note_path,
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(include_columns=['hadm_id', 'text'], column_types={'hadm_id': pa.int64()}),
+    )
     # Filter for our admissions
-    notes_df = notes_df[notes_df['hadm_id'].isin(hadm_ids)]
+    hadm_id_set = pa.array(list(set(hadm_ids)), type=pa.int64())
+    num_notes = 0
+    batches = []
+    for batch in reader:
+        num_notes += batch.num_rows
+        batches.append(batch.filter(pc.is_in(batch.column('hadm_id'), value_set=hadm_id_set)))
+    notes_df = pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+    print(f"Loaded {num_notes} total discharge notes")
     print(f"Found notes for {len(notes_df)} out of {len(hadm_ids)} admissions")
     
     return notes_df
 
 
-def enrich_patient_records(patient_records, notes_df):
-    """Enrich patient records with information from notes"""
+def count_nulls(record):
+    """Count the null fields of a patient record, ignoring the id and vocabulary fields"""
+    return sum(1 for k, v in record.items() if v is None and k not in EXCLUDED_FIELDS)
+
+
+def enrich_record(record, note_text):
+    """Fill the null fields of a patient record from its discharge note; returns the record and its null counts before and after"""
+    # Extract sections
+    sections = extract_note_sections(note_text)
+    
+    # Count nulls before
+    nulls_before = count_nulls(record)
+    
+    # Extract from social history
+    if sections.get('Social History'):
+        social_fields = extract_from_social_history(sections['Social History'])
+        for key, value in social_fields.items():
+            if record.get(key) is None:
+                record[key] = value
+    
+    # Extract from other sections
+    other_fields = extract_from_other_sections(sections)
+    for key, value in other_fields.items():
+        if record.get(key) is None:
+            record[key] = value
+    
+    # Count nulls after
+    nulls_after = count_nulls(record)
+    return record, nulls_before, nulls_after
+
+
+def enrich_patient_records(patient_records, notes_df, num_workers=None):
+    """Enrich patient records with information from notes, using num_workers processes (default: one per CPU)"""
     enriched_records = []
     
-    for i, record in enumerate(patient_records, 1):
-        # Extract hadm_id
-        hadm_id = int(record['hadm_id'].replace('patient_', ''))
-        
-        # Find matching note
-        note_rows = notes_df[notes_df['hadm_id'] == hadm_id]
-        
-        if len(note_rows) == 0:
+    # Note text by hadm_id, taking the first note if multiple, so each patient is a dict lookup instead of a scan of notes_df
+    note_texts = notes_df.drop_duplicates('hadm_id').set_index('hadm_id')['text'].to_dict()
+    
+    # Find matching note
+    work = [(record, note_texts.get(int(record['hadm_id'].replace('patient_', '')))) for record in patient_records]
+    
+    # The extraction is CPU-bound and independent per patient, so the records with a note are enriched in a process pool
+    with multiprocessing.Pool(num_workers) as pool:
+        results = iter(pool.starmap(enrich_record, [(record, note_text) for record, note_text in work if note_text is not None], chunksize=32))
+    
+    for i, (record, note_text) in enumerate(work, 1):
+        if note_text is None:
             print(f"  Patient {i}: No note found")
             enriched_records.append(record)
             continue
         
-        # Take first note if multiple
-        note_text = note_rows.iloc[0]['text']
-        
-        # Extract sections
-        sections = extract_note_sections(note_text)
-        
-        # Count nulls before
-        exclude_fields = ['hadm_id', 'cefr_A1', 'cefr_A2', 'cefr_B1', 'cefr_B2', 'cefr_C1', 'cefr_C2', 'med_A', 'med_B', 'med_C']
-        nulls_before = sum(1 for k, v in record.items() if k not in exclude_fields and v is None)
-        
-        # Extract from social history
-        if sections.get('Social History'):
-            social_fields = extract_from_social_history(sections['Social History'])
-            for key, value in social_fields.items():
-                if record.get(key) is None:
-                    record[key] = value
-        
-        # Extract from other sections
-        other_fields = extract_from_other_sections(sections)
-        for key, value in other_fields.items():
-            if record.get(key) is None:
-                record[key] = value
-        
-        # Count nulls after
-        nulls_after = sum(1 for k, v in record.items() if k not in exclude_fields and v is None)
+        record, nulls_before, nulls_after = next(results)
         filled = nulls_before - nulls_after
         
         if filled > 0:
@@ -435,14 +490,12 @@ def main():
     
     # Summary statistics
     print("\n4. Summary:")
-    exclude_fields = ['hadm_id', 'cefr_A1', 'cefr_A2', 'cefr_B1', 'cefr_B2', 'cefr_C1', 'cefr_C2', 'med_A', 'med_B', 'med_C']
-    
     total_orig_nulls = 0
     total_enriched_nulls = 0
     
     for orig, enriched in zip(patient_records, enriched_records):
-        orig_nulls = sum(1 for k, v in orig.items() if k not in exclude_fields and v is None)
-        enriched_nulls = sum(1 for k, v in enriched.items() if k not in exclude_fields and v is None)
+        orig_nulls = count_nulls(orig)
+        enriched_nulls = count_nulls(enriched)
         total_orig_nulls += orig_nulls
         total_enriched_nulls += enriched_nulls
     
@@ -5,10 +5,18 @@ Enhanced version using MIMIC-IV-ED for pain, chiefcomplaint, and medication data
 
 import pandas as pd
 import json
+import re
 import numpy as np
 from load_mimic4_data import MIMIC4DataLoader
 
 
+# HPI section of a discharge note, up to the past medical history
+HPI_SECTION_RE = re.compile(
+    r'History of Present Illness:\s*\n(.*?)(?:\nPast Medical History:|\nPMH:)',
+    re.DOTALL | re.IGNORECASE
+)
+
+
 def get_first_ed_visits_enhanced(loader, n_patients=50, n_candidates=1000):
     """
     Get first ED visits with enhanced data from MIMIC-IV-ED
@@ -29,8 +37,10 @@ def get_first_ed_visits_enhanced(loader, n_patients=50, n_candidates=1000):
     try:
         import os
         note_path = '../../mimic_4/note/discharge.csv.gz'
-        notes_df = pd.read_csv(note_path)
-        print(f"Loaded {len(notes_df)} discharge notes")
+        # Only the id and the text of the notes are used. The file is only opened here; it is streamed in
+        # chunks once the first visits are known, keeping just their notes instead of the whole table
+        note_reader = pd.read_csv(note_path, usecols=['hadm_id', 'text'], chunksize=50_000)
+        print(f"Opened {note_path}")
         has_notes = True
     except Exception as e:
         print(f"⚠️  Could not load discharge notes: {e}")
@@ -88,66 +98,83 @@ def get_first_ed_visits_enhanced(loader, n_patients=50, n_candidates=1000):
     
     # Merge with medication reconciliation
     print("Processing medication reconciliation...")
-    medrecon_grouped = medrecon.groupby('stay_id')['name'].apply(
-        lambda x: ', '.join(x.dropna().unique()[:10])
-    ).reset_index()
+    # First 10 distinct medication names of every stay, without a Python callback per stay; stays with
+    # only missing names keep an empty string, as groupby().first() below treats it as a value
+    medications = medrecon.dropna(subset=['name']).drop_duplicates(['stay_id', 'name'])
+    medrecon_grouped = (
+        medications.groupby('stay_id').head(10)
+        .groupby('stay_id')['name']
+        .agg(', '.join)
+        .reindex(medrecon['stay_id'].dropna().unique(), fill_value='')
+        .rename_axis('stay_id')
+        .reset_index()
+    )
     medrecon_grouped.columns = ['stay_id', 'ed_medications']
     ed_data = ed_data.merge(medrecon_grouped, on='stay_id', how='left')
     print(f"After medrecon merge: {len(ed_data)}")
     
+    # Arrow-backed strings for the text columns the filters below scan; their .str methods run as
+    # pyarrow kernels instead of per-element on Python objects
+    string_columns = ['gender', 'race', 'marital_status', 'insurance', 'chiefcomplaint']
+    ed_data[string_columns] = ed_data[string_columns].astype('string[pyarrow]')
+    
     # Apply filters
     print(f"\n{'='*80}")
     print("Applying filters...")
     print(f"{'='*80}")
     
+    # Every filter is added to one cumulative mask and the surviving rows are copied once at the end;
+    # the count after each step is taken from the mask
     # Age filter
-    ed_data = ed_data[
-        (ed_data['age_at_admission'] >= 18) & 
-        (ed_data['age_at_admission'] <= 89)
-    ]
-    print(f"After age filter (18-89): {len(ed_data)}")
+    keep = (ed_data['age_at_admission'] >= 18) & (ed_data['age_at_admission'] <= 89)
+    print(f"After age filter (18-89): {keep.sum()}")
     
     # Gender filter
-    ed_data = ed_data[ed_data['gender'].isin(['M', 'F'])]
-    print(f"After gender filter: {len(ed_data)}")
+    keep &= ed_data['gender'].isin(['M', 'F'])
+    print(f"After gender filter: {keep.sum()}")
     
     # Race filter
-    ed_data = ed_data[
+    keep &= (
         (ed_data['race'].notna()) & 
         (ed_data['race'] != 'UNKNOWN') &
         (ed_data['race'] != 'UNABLE TO OBTAIN') &
         (~ed_data['race'].str.contains('PATIENT DECLINED', na=False))
-    ]
-    print(f"After race filter: {len(ed_data)}")
+    )
+    print(f"After race filter: {keep.sum()}")
     
     # Marital status filter
-    ed_data = ed_data[ed_data['marital_status'].notna()]
-    print(f"After marital status filter: {len(ed_data)}")
+    keep &= ed_data['marital_status'].notna()
+    print(f"After marital status filter: {keep.sum()}")
     
     # Insurance filter
-    ed_data = ed_data[ed_data['insurance'].notna()]
-    print(f"After insurance filter: {len(ed_data)}")
+    keep &= ed_data['insurance'].notna()
+    print(f"After insurance filter: {keep.sum()}")
     
     # Chief complaint filter
-    ed_data = ed_data[
+    keep &= (
         (ed_data['chiefcomplaint'].notna()) &
-        (~ed_data['chiefcomplaint'].str.lower().str.contains(
+        (~ed_data['chiefcomplaint'].str.contains(
             'transfer|ams|altered mental status|confusion|slurred speech|dysarthria|aphasia',
+            case=False,
             na=False
         ))
-    ]
-    print(f"After chiefcomplaint filter: {len(ed_data)}")
+    )
+    print(f"After chiefcomplaint filter: {keep.sum()}")
     
     # Pain filter (0-10 or null)
     ed_data['pain'] = pd.to_numeric(ed_data['pain'], errors='coerce')
-    ed_data = ed_data[
+    keep &= (
         (ed_data['pain'].isna()) | 
         ((ed_data['pain'] >= 0) & (ed_data['pain'] <= 10))
-    ]
+    )
+    ed_data = ed_data.loc[keep]
     print(f"After pain filter (0-10 or null): {len(ed_data)}")
     
     # Get first ED visit per patient
     print(f"\nFinding first ED visit per patient...")
+    # groupby().first() takes the first non-null value of every column, so missing fields of the first
+    # visit are filled from the patient's later visits; drop_duplicates() would keep the nulls and select
+    # a different set of candidates
     ed_data = ed_data.sort_values(['subject_id', 'admittime'])
     first_visits = ed_data.groupby('subject_id').first().reset_index()
     print(f"First ED visits: {len(first_visits)}")
@@ -155,9 +182,22 @@ def get_first_ed_visits_enhanced(loader, n_patients=50, n_candidates=1000):
     # Filter for patients with discharge notes containing HPI
     if has_notes:
         print(f"\nFiltering for patients with History of Present Illness in notes...")
-        # Get notes for these admissions
-        candidate_notes = notes_df[notes_df['hadm_id'].isin(first_visits['hadm_id'])].copy()
-        
+        # Get notes for these admissions. The file is only read here, so a read error partway through
+        # the stream falls back to running without notes, like a failure to open it above
+        try:
+            num_notes = 0
+            candidate_chunks = []
+            for chunk in note_reader:
+                num_notes += len(chunk)
+                candidate_chunks.append(chunk[chunk['hadm_id'].isin(first_visits['hadm_id'])])
+            candidate_notes = pd.concat(candidate_chunks)
+            print(f"  Loaded {num_notes} discharge notes")
+        except Exception as e:
+            print(f"⚠️  Could not load discharge notes: {e}")
+            print("   Cannot filter for present illness information")
+            has_notes = False
+    
+    if has_notes:
         # Check for HPI section
         candidate_notes['has_hpi'] = candidate_notes['text'].str.contains(
             'History of Present Illness:', 
@@ -166,24 +206,12 @@ def get_first_ed_visits_enhanced(loader, n_patients=50, n_candidates=1000):
         )
         
         # Check that HPI section has substantial content (>50 chars)
-        def check_hpi_content(text):
-            if pd.isna(text) or 'History of Present Illness:' not in text:
-                return False
-            try:
-                import re
-                match = re.search(
-                    r'History of Present Illness:\s*\n(.*?)(?:\nPast Medical History:|\nPMH:)',
-                    text,
-                    re.DOTALL | re.IGNORECASE
-                )
-                if match:
-                    hpi_text = match.group(1).strip()
-                    return len(hpi_text) > 50
-            except:
-                pass
-            return False
-        
-        candidate_notes['has_hpi_content'] = candidate_notes['text'].apply(check_hpi_content)
+        # (the header must appear with this exact case, the section itself is matched case-insensitively)
+        hpi_text = candidate_notes['text'].str.extract(HPI_SECTION_RE, expand=False).str.strip()
+        candidate_notes['has_hpi_content'] = (
+            candidate_notes['text'].str.contains('History of Present Illness:', regex=False, na=False) &
+            (hpi_text.str.len() > 50)
+        )
         
         valid_hadm_ids = candidate_notes[candidate_notes['has_hpi_content']]['hadm_id'].unique()
         
@@ -248,19 +276,31 @@ def create_patient_records_enhanced(selected_visits, visit_diagnoses, vocab_word
     print(f"Creating patient records...")
     print(f"{'='*80}")
     
-    for idx, row in selected_visits.iterrows():
+    # Primary diagnosis and medical history (first 5 secondary diagnoses) of every admission,
+    # built once instead of scanning visit_diagnoses for each patient
+    primary_diagnoses = (
+        visit_diagnoses[visit_diagnoses['seq_num'] == 1]
+        .drop_duplicates('hadm_id')
+        .set_index('hadm_id')['long_title']
+        .to_dict()
+    )
+    secondary_diagnoses = visit_diagnoses[visit_diagnoses['seq_num'] > 1]
+    medical_histories = (
+        secondary_diagnoses.groupby('hadm_id').head(5)
+        .groupby('hadm_id')['long_title']
+        .agg('; '.join)
+        .to_dict()
+    )
+    
+    # Plain dicts per visit are much cheaper to build than the Series of iterrows()
+    for row in selected_visits.to_dict('records'):
         hadm_id = row['hadm_id']
         
         # Get diagnoses
-        patient_diags = visit_diagnoses[visit_diagnoses['hadm_id'] == hadm_id]
-        primary_diagnosis = patient_diags[patient_diags['seq_num'] == 1]['long_title'].values
-        diagnosis_text = primary_diagnosis[0] if len(primary_diagnosis) > 0 else None
+        diagnosis_text = primary_diagnoses.get(hadm_id)
         
         # Medical history from secondary diagnoses
-        secondary_diags = patient_diags[patient_diags['seq_num'] > 1]['long_title'].values
-        medical_history_text = None
-        if len(secondary_diags) > 0:
-            medical_history_text = '; '.join(secondary_diags[:5])
+        medical_history_text = medical_histories.get(hadm_id)
         
         # Get ED medications
         medication_text = row.get('ed_medications')